@@ -1,19 +1,46 @@
-import requests
+import hashlib
+import json
+from decouple import config
 
-# Replace with your API base URL and access credentials (if required)
-API_BASE_URL = "https://snowstorm.prod.projectronin.io"
-# API_ACCESS_KEY = "your_api_access_key"
+from models import http_client
+from models.candidate_finder import DEFAULT_LIMIT, CandidateFinder
+from models.decision_store import DecisionStore
+from models.concurrency import DEFAULT_MAX_WORKERS, map_concurrently
+from models.fuzzy_matcher import DEFAULT_THRESHOLD, FuzzyMatcher
+from models.metrics import METRICS
+from models.normalizer import Normalizer, load_synonym_table
+from models.records import MatchResult
+from models.substitutes import ACTIVE_SUBSTITUTE, SubstituteResolver
+from models.snowstorm import (
+    SnowstormError, get_concept, get_descriptions, get_concepts_bulk, get_descriptions_bulk, get_release,
+    use_cache_store, use_rf2_index,
+)
+from models.term_index import TermIndex
 
 SYNONYMS = {
     "tumor": "neoplasm",
     "secondary": "metastatic",
 }
 
+IGNORABLE_STRINGS = [", NOS", ", not otherwise specified"]
+
+_normalizer = Normalizer(SYNONYMS)
+
+METRICS.register_gauge("cache_hit_ratio", lambda: _normalizer.hit_ratio(), cache="normalize")
+
 def normalize_synonyms(text):
     """Function to normalize synonyms in a given text"""
-    words = text.split()
-    normalized_words = [SYNONYMS.get(word.lower(), word) for word in words]
-    return " ".join(normalized_words)
+    return _normalizer.normalize(text)
+
+def load_synonyms(path):
+    """
+    Adds the synonyms of a JSON or CSV synonym table (see models.normalizer.load_synonym_table) to SYNONYMS
+    and recompiles the normalizer. Term indexes built with the previous synonyms are discarded.
+    """
+    global _normalizer
+    SYNONYMS.update(load_synonym_table(path))
+    _normalizer = Normalizer(SYNONYMS)
+    _term_indexes.clear()
 
 def get_concept_data(concept_id, branch="MAIN"):
     """
@@ -27,18 +54,14 @@ def get_concept_data(concept_id, branch="MAIN"):
     Returns:
         tuple: A tuple containing the preferred term, fully specified name, and status of the concept.
     """
-    url = f"{API_BASE_URL}/{branch}/concepts/{concept_id}"
-    response = requests.get(url)
+    concept_data = get_concept(concept_id, branch)
 
-    # Process the API response
-    if response.status_code == 200:
-        concept_data = response.json()
+    if concept_data is not None:
         preferred_term = concept_data["pt"]["term"]
         fully_specified_name = concept_data["fsn"]["term"]
         is_active = concept_data["active"]
         return preferred_term, fully_specified_name, is_active
     else:
-        print(f"Error fetching data for concept ID {concept_id}: {response.status_code}")
         return None, None, None
 
 def get_concept_descriptions(concept_id, branch="MAIN"):
@@ -52,26 +75,310 @@ def get_concept_descriptions(concept_id, branch="MAIN"):
     Returns:
         list: A list of description terms for the given concept ID.
     """
-    url = f"{API_BASE_URL}/{branch}/concepts/{concept_id}/descriptions"
-    headers = {
-        "Accept-Language": "en-X-900000000000509007"
-    }
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        descriptions_data = response.json()
-        descriptions = descriptions_data["conceptDescriptions"]
-        filtered_terms = [
-            normalize_synonyms(desc['term']) for desc in descriptions
-            if any(value in {"ACCEPTABLE", "PREFERRED"} for value in desc["acceptabilityMap"].values())
-        ]
+    descriptions = get_descriptions(concept_id, branch)
+
+    if descriptions is not None:
+        filtered_terms = [normalize_synonyms(term) for term in filter_acceptable_terms(descriptions)]
         return filtered_terms
     else:
-        print(f"Error fetching descriptions for concept ID {concept_id}: {response.status_code}")
         return None
 
+def filter_acceptable_terms(descriptions):
+    """Returns the terms of the descriptions that are acceptable or preferred in any language refset"""
+    return [
+        desc['term'] for desc in descriptions
+        if any(value in {"ACCEPTABLE", "PREFERRED"} for value in desc["acceptabilityMap"].values())
+    ]
+
+FUZZY_THRESHOLD = DEFAULT_THRESHOLD
+
+# One term index per branch, shared by every match_code call
+_term_indexes = {}
+_candidate_finders = {}
+_fuzzy_matchers = {}
+# Inactive concept to active substitute; empty until load_substitutes is called
+_substitute_resolver = SubstituteResolver()
+
+
+def get_term_index(branch="MAIN"):
+    """
+    Returns the shared term index for the branch, creating an empty one if needed.
+    """
+    if branch not in _term_indexes:
+        _term_indexes.setdefault(branch, TermIndex(normalize_synonyms, IGNORABLE_STRINGS))
+    return _term_indexes[branch]
+
+
+def load_term_index(path, branch="MAIN"):
+    """
+    Replaces the shared term index for the branch with one previously saved to `path`, if the file exists
+    and was built from the current release of the branch with the current synonyms and ignorable strings
+    (see term_index_fingerprint). Otherwise the index starts empty and is rebuilt as concepts are indexed.
+    """
+    _term_indexes[branch] = TermIndex.load_or_create(
+        path, normalize_synonyms, IGNORABLE_STRINGS, term_index_fingerprint(branch)
+    )
+    return _term_indexes[branch]
+
+
+def term_index_fingerprint(branch="MAIN"):
+    """
+    Identifies what the terms of a branch's index depend on: the content of the branch and the
+    normalization (synonyms and ignorable strings).
+
+    Returns:
+        str: The fingerprint saved with the index, or None if the branch could not be fetched.
+    """
+    release = get_release(branch)
+    if release is None:
+        return None
+    configuration = json.dumps([sorted(SYNONYMS.items()), IGNORABLE_STRINGS])
+    return f"{release}:{hashlib.sha1(configuration.encode()).hexdigest()[:12]}"
+
+
+def index_concepts(concept_ids, branch="MAIN"):
+    """
+    Adds the given concepts to the branch's term index, fetching the ones not indexed yet in bulk.
+
+    Args:
+        concept_ids (iterable): The SNOMED concept IDs to index.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+    """
+    term_index = get_term_index(branch)
+    missing = [concept_id for concept_id in dict.fromkeys(concept_ids) if concept_id not in term_index]
+    if not missing:
+        return
+    concepts = get_concepts_bulk(missing, branch)
+    descriptions = get_descriptions_bulk(list(concepts), branch)
+    for concept_id, concept in concepts.items():
+        term_index.add_concept(
+            concept_id,
+            concept["pt"]["term"],
+            concept["fsn"]["term"],
+            filter_acceptable_terms(descriptions.get(concept_id, [])),
+        )
+
+
+def find_candidates(text, branch="MAIN", limit=DEFAULT_LIMIT):
+    """
+    Finds candidate SNOMED concepts for display text that came without a SNOMED code, searching the
+    concepts of the branch's term index. To search a whole release, first index every concept of a
+    local RF2 index: use_rf2_index(path), then index_concepts(RF2Index(path).concept_ids()).
+
+    Args:
+        text (str): The display text of the condition.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+        limit (int): Maximum number of candidates returned (default: DEFAULT_LIMIT).
+
+    Returns:
+        list: (concept ID, score, matched reason or matched term) tuples, best first; see CandidateFinder.find.
+    """
+    term_index = get_term_index(branch)
+    finder = _candidate_finders.get(branch)
+    if finder is None or finder.term_index is not term_index:
+        finder = _candidate_finders[branch] = CandidateFinder(term_index)
+    else:
+        finder.refresh()
+    return finder.find(text, limit)
+
+
+def get_fuzzy_matcher(branch="MAIN"):
+    """
+    Returns the FUZZY tier matcher over the branch's term index.
+    """
+    term_index = get_term_index(branch)
+    matcher = _fuzzy_matchers.get(branch)
+    if matcher is None or matcher.term_index is not term_index:
+        matcher = _fuzzy_matchers[branch] = FuzzyMatcher(term_index, FUZZY_THRESHOLD)
+    return matcher
+
+
+def load_substitutes(db_path):
+    """
+    Loads the active substitutes of inactive concepts from the historical associations of a local RF2
+    index (see models.rf2_index). Without them, matches on inactive concepts go to manual mapping.
+    """
+    global _substitute_resolver
+    _substitute_resolver = SubstituteResolver.from_rf2_index(db_path)
+
+
+def substitute_inactive(result, branch="MAIN"):
+    """
+    Replaces a match on an inactive concept with its active substitute (matched reason ACTIVE SUBSTITUTE),
+    or drops the match when the concept has no substitute, since maps may only target active concepts.
+
+    Args:
+        result (MatchResult): The result of matching the display text against the supplied code.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        MatchResult: The result unchanged if the matched concept is active or there is no match.
+    """
+    if result.matched_code is None or get_concept_data(result.matched_code, branch)[2] is not False:
+        return result
+    with METRICS.timed("match_substitute"):
+        substitute = _substitute_resolver.resolve(result.matched_code)
+    if substitute is None:
+        return MatchResult(None, None, None, result.similarity)
+    return MatchResult(substitute, ACTIVE_SUBSTITUTE, get_concept_data(substitute, branch)[1], result.similarity)
+
+
+def match_code(code, input_display, branch="MAIN", fuzzy=True):
+    """
+    Checks whether the input display text matches the given SNOMED concept.
+
+    Args:
+        code (str): The SNOMED concept ID supplied by the source system.
+        input_display (str): The display text supplied by the source system.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+        fuzzy (bool): Try the FUZZY tier when no other tier matches (default: True). match_codes turns
+            it off and scores the whole batch at once instead.
+
+    Returns:
+        MatchResult: The matched code, the matched reason and the fully specified name of the matched code,
+        all None if there is no match, and the similarity score (1.0 for the EXACT, SYNONYM and
+        NORMALIZED DESCRIPTION tiers, the best fuzzy score otherwise, None if not scored). A match on an
+        inactive concept is replaced by its active substitute, see substitute_inactive.
+    """
+    preferred_term, fully_specified_name, is_active = get_concept_data(code, branch)
+    index_concepts([code], branch)
+
+    matched_code = None
+    fsn_for_matched_code = None
+    # Decides the EXACT, SYNONYM and NORMALIZED DESCRIPTION tiers in one pass
+    with METRICS.timed("match_terms"):
+        matched_reason = get_term_index(branch).match(code, input_display)
+    similarity = 1.0 if matched_reason else None
+    if not matched_reason and fuzzy:
+        with METRICS.timed("match_fuzzy"):
+            matched_reason, similarity = get_fuzzy_matcher(branch).match([(code, input_display)])[0]
+    if matched_reason:
+        matched_code = code
+        fsn_for_matched_code = fully_specified_name
+
+    result = MatchResult(matched_code, matched_reason, fsn_for_matched_code, similarity)
+    if is_active is False:
+        result = substitute_inactive(result, branch)
+    return result
+
+
+def match_text(input_display, branch="MAIN"):
+    """
+    Matches display text that came without a SNOMED code against the concepts of the branch's term index.
+    The text is only matched when it hits exactly one concept on the EXACT, SYNONYM or NORMALIZED
+    DESCRIPTION tiers; near or ambiguous hits are left to a reviewer.
+
+    Args:
+        input_display (str): The display text supplied by the source system.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        tuple: The MatchResult, with the same fields as match_code's, and the candidates found for the
+        text (see find_candidates).
+    """
+    candidates = find_candidates(input_display, branch)
+    hits = [candidate for candidate in candidates if candidate[1] >= 1]
+    if len(hits) != 1:
+        return MatchResult(None, None, None, None), candidates
+    concept_id, similarity, matched_reason = hits[0]
+    result = MatchResult(concept_id, matched_reason, get_concept_data(concept_id, branch)[1], similarity)
+    return substitute_inactive(result, branch), candidates
+
+
+def match_codes(items, branch="MAIN", max_workers=DEFAULT_MAX_WORKERS, decisions=None, return_exceptions=False):
+    """
+    Matches a batch of (code, display text) pairs. The EXACT, SYNONYM and NORMALIZED DESCRIPTION tiers
+    run concurrently per pair, then the pairs left unmatched go through the FUZZY tier as one batch.
+
+    Args:
+        items (list): (SNOMED concept ID, display text) tuples.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+        max_workers (int): Maximum number of pairs matched concurrently (default: DEFAULT_MAX_WORKERS).
+        decisions (DecisionStore): If given, pairs decided in an earlier run are answered from it and
+            only the others are matched; their results are recorded in it (default: None).
+        return_exceptions (bool): Return the SnowstormError of a pair whose concept could not be looked
+            up in place of its result (default: False: the pair gets a result without match).
+
+    Returns:
+        list: The match_code result of every pair, in input order. A pair whose lookup failed is not
+        recorded in `decisions`.
+    """
+    if decisions is None:
+        results = _match_pending(items, branch, max_workers)
+    else:
+        results = [decisions.get(code, display) for code, display in items]
+        pending = list(dict.fromkeys(items[position] for position, result in enumerate(results) if result is None))
+        if pending:
+            decided = dict(zip(pending, _match_pending(pending, branch, max_workers)))
+            # a failed lookup is not a decision: the pair is matched again next time
+            decisions.record_many([
+                (code, display, result) for (code, display), result in decided.items()
+                if not isinstance(result, SnowstormError)
+            ])
+            decisions.commit()
+            results = [result if result is not None else decided[item] for item, result in zip(items, results)]
+    if return_exceptions:
+        return results
+    return [MatchResult(None, None, None, None) if isinstance(result, SnowstormError) else result for result in results]
+
+
+def _match_pending(items, branch, max_workers):
+    """
+    Matches pairs through every tier; the result of a pair whose concept could not be looked up is its SnowstormError.
+    """
+    def match(item):
+        try:
+            return match_code(item[0], item[1], branch, fuzzy=False)
+        except SnowstormError as error:
+            print(f"Could not match {item[1]!r} to {item[0]}: {error}")
+            return error
+
+    results = list(map_concurrently(match, items, max_workers))
+    unmatched = [
+        position for position, result in enumerate(results)
+        if not isinstance(result, SnowstormError) and result.matched_code is None
+    ]
+    with METRICS.timed("match_fuzzy"):
+        fuzzy_results = get_fuzzy_matcher(branch).match([items[position] for position in unmatched])
+    for position, (matched_reason, similarity) in zip(unmatched, fuzzy_results):
+        code = items[position][0]
+        if matched_reason:
+            try:
+                results[position] = substitute_inactive(
+                    MatchResult(code, matched_reason, get_concept_data(code, branch)[1], similarity), branch
+                )
+            except SnowstormError as error:
+                print(f"Could not match {items[position][1]!r} to {code}: {error}")
+                results[position] = error
+        else:
+            results[position] = results[position]._replace(similarity=similarity)
+    for result in results:
+        if isinstance(result, SnowstormError):
+            METRICS.count("lookup_failures")
+        else:
+            METRICS.count("match_reasons", reason=result.matched_reason or "NO MATCH")
+    return results
+
+
+def decision_release(branch="MAIN"):
+    """
+    Identifies what the decisions for a branch depend on: the content of the branch and the matcher
+    configuration (synonyms, ignorable strings, fuzzy threshold and loaded substitutes). Changing either invalidates the
+    decisions stored by an earlier run.
+
+    Returns:
+        str: The release key for a DecisionStore, or None if the branch could not be fetched.
+    """
+    release = get_release(branch)
+    if release is None:
+        return None
+    configuration = json.dumps([sorted(SYNONYMS.items()), IGNORABLE_STRINGS, FUZZY_THRESHOLD, _substitute_resolver.fingerprint])
+    return f"{release}:{hashlib.sha1(configuration.encode()).hexdigest()[:12]}"
+
+
 # Main function to test the matching of input codes
-def main():
+def main(max_workers=DEFAULT_MAX_WORKERS, term_index_path=None, decision_store_path=None, rf2_index_path=None,
+         concept_cache_path=None, use_rf2=False):
     input_codes = [
         {"code": "386661006", "display": "Fever", "expected_matched_reason": "EXACT"},
         {"code": "422587007", "display": "Nausea", "expected_matched_reason": "EXACT"},
@@ -92,58 +399,53 @@ def main():
         
     ]
 
-    ignorable_strings = [", NOS", ", not otherwise specified"]
-
-    for item in input_codes:
-        code = item["code"]
-        input_display = item["display"]
-        preferred_term, fully_specified_name, is_active = get_concept_data(code)
-        concept_descriptions = get_concept_descriptions(code)
-
-        matched_code = None
-        fsn_for_matched_code = None
-        matched_reason = None
-
-        # Check for exact messages
-        if input_display == preferred_term or input_display == fully_specified_name:
-            matched_code = code
-            fsn_for_matched_code = get_concept_data(matched_code)[1]
-            matched_reason = "EXACT"
+    http_client.set_pool_size(max_workers)
+    if rf2_index_path and use_rf2:
+        # every lookup is answered from the local RF2 index, without Snowstorm
+        use_rf2_index(rf2_index_path)
+    elif concept_cache_path:
+        use_cache_store(concept_cache_path)
+    if rf2_index_path:
+        load_substitutes(rf2_index_path)
+    decisions = None
+    if decision_store_path:
+        release = decision_release()
+        if release is None:
+            print("Could not identify the release, matching every pair again")
         else:
-            normalized_input_display = normalize_synonyms(input_display)
-            descriptions_to_check = [normalize_synonyms(term) for term in
-                                     [preferred_term, fully_specified_name] + concept_descriptions]
-
-            # Check for synonym matches
-            if any(normalized_input_display == description for description in descriptions_to_check):
-                matched_code = code
-                fsn_for_matched_code = get_concept_data(matched_code)[1]
-                matched_reason = "SYNONYM"
-            else:
-                modified_display = normalized_input_display
-                for string in ignorable_strings:
-                    modified_display = modified_display.replace(string, '')
-
-                if any(modified_display == description for description in descriptions_to_check):
-                    matched_code = code
-                    fsn_for_matched_code = get_concept_data(matched_code)[1]
-                    matched_reason = "NORMALIZED DESCRIPTION"
-                else:
-                    print("NO MATCH", input_display)
-
-        if not is_active:
-            pass
-            # Lookup an appropriate substitute
-            # set matched_code to be the substitute
-            # Matched reason: ACTIVE SUBSTITUTE
+            decisions = DecisionStore(decision_store_path, "MAIN", release)
+            if decisions.invalidated:
+                print(f"Release changed, dropped {decisions.invalidated} earlier decisions")
+
+    # only the concepts of pairs not decided in an earlier run need to be fetched and indexed
+    concept_ids = [
+        item["code"] for item in input_codes
+        if decisions is None or decisions.get(item["code"], item["display"]) is None
+    ]
+    if term_index_path:
+        load_term_index(term_index_path)
+    index_concepts(concept_ids)
+    if term_index_path:
+        get_term_index().save(term_index_path)
+    get_fuzzy_matcher().fit()
 
+    results = match_codes(
+        [(item["code"], item["display"]) for item in input_codes], max_workers=max_workers, decisions=decisions
+    )
+    for item, (matched_code, matched_reason, fsn_for_matched_code, similarity) in zip(input_codes, results):
         if matched_code:
-            print(matched_reason, "MATCH", input_display, code, fsn_for_matched_code)
+            print(matched_reason, "MATCH", item["display"], item["code"], fsn_for_matched_code, similarity)
         else:
-            print("NO MATCH", input_display)
+            print("NO MATCH", item["display"])
         if matched_reason != item.get('expected_matched_reason'):
             print("--------- UNEXPECTED RESULT -----------")
+    if decisions is not None:
+        decisions.close()
 
 
 if __name__ == "__main__":
-    main()
+    main(
+        rf2_index_path=config("RF2_INDEX_FILE", default=None),
+        concept_cache_path=config("CONCEPT_CACHE_DB", default=None),
+        use_rf2=config("USE_RF2_INDEX", default=False, cast=bool),
+    )
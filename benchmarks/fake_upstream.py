@@ -0,0 +1,187 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+US_ENGLISH = "900000000000509007"
+SNOMED_SYSTEMS = ["http://snomed.info/sct", "urn:oid:2.16.840.1.113883.6.96"]
+SNOWSTORM_PREFIX = "/snowstorm"
+INTERNAL_TOOLS_PREFIX = "/infx"
+SEMANTIC_TAG = re.compile(r"\s*\([^()]*\)$")
+
+
+def concepts_from_conditions(path):
+    """
+    Builds the fake terminology from the SNOMED codings of a file shaped like sample_data.json: the coding
+    display is used as the FSN and, without its semantic tag, as the PT; the condition text as a synonym.
+
+    Returns:
+        dict: Concept ID to (pt, fsn, synonyms).
+    """
+    with open(path) as input_file:
+        conditions = json.load(input_file)
+    concepts = {}
+    for condition in conditions:
+        for coding in condition["coding"]:
+            if coding["system"] in SNOMED_SYSTEMS and coding["code"] not in concepts:
+                fsn = coding.get("display") or condition["text"]
+                pt = SEMANTIC_TAG.sub("", fsn)
+                synonyms = [condition["text"]] if condition["text"] not in (pt, fsn) else []
+                concepts[coding["code"]] = (pt, fsn, synonyms)
+    return concepts
+
+
+class FakeUpstream:
+    """
+    Local stand-in for Snowstorm (under /snowstorm) and infx-internal (under /infx), serving the
+    endpoints this repo calls with a configurable latency and error rate.
+
+    Concepts not in the given terminology are synthesized from their ID, so generated conditions with
+    codes of their own resolve too. Every request is counted per upstream.
+    """
+
+    def __init__(self, concepts=None, latency=0.0, error_rate=0.0, seed=0, port=0):
+        """
+        Args:
+            concepts (dict): Concept ID to (pt, fsn, synonyms), see concepts_from_conditions (default: None).
+            latency (float): Seconds added to every response (default: 0.0).
+            error_rate (float): Fraction of requests answered with a 503 (default: 0.0).
+            seed (int): Seed of the error draws (default: 0).
+            port (int): Port to listen on (default: 0, any free port).
+        """
+        self.concepts = concepts or {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def snowstorm_url(self):
+        return self.base_url + SNOWSTORM_PREFIX
+
+    @property
+    def internal_tools_url(self):
+        return self.base_url + INTERNAL_TOOLS_PREFIX
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def concept(self, concept_id):
+        pt, fsn, _ = self.concepts.get(
+            concept_id, (f"Synthetic condition {concept_id}", f"Synthetic condition {concept_id} (disorder)", [])
+        )
+        return {"conceptId": concept_id, "active": True, "pt": {"term": pt, "lang": "en"}, "fsn": {"term": fsn, "lang": "en"}}
+
+    def descriptions(self, concept_id):
+        pt, fsn, synonyms = self.concepts.get(
+            concept_id, (f"Synthetic condition {concept_id}", f"Synthetic condition {concept_id} (disorder)", [])
+        )
+        terms = [(fsn, "FSN", "PREFERRED"), (pt, "SYNONYM", "PREFERRED")]
+        terms += [(synonym, "SYNONYM", "ACCEPTABLE") for synonym in synonyms]
+        return [
+            {
+                "descriptionId": f"{concept_id}{number}",
+                "conceptId": concept_id,
+                "active": True,
+                "term": term,
+                "type": description_type,
+                "acceptabilityMap": {US_ENGLISH: acceptability},
+            }
+            for number, (term, description_type, acceptability) in enumerate(terms)
+        ]
+
+    def _should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _count(self, upstream):
+        with self._lock:
+            self.requests[upstream] += 1
+
+    def _snowstorm(self, path, query):
+        parts = path.strip("/").split("/")
+        if parts[0] == "branches":
+            return 200, {"path": "/".join(parts[1:]), "headTimestamp": 1}
+        if parts[-1] == "concepts":
+            concept_ids = query.get("conceptIds", [])
+            return 200, {"items": [self.concept(concept_id) for concept_id in concept_ids], "total": len(concept_ids)}
+        if parts[-1] == "descriptions" and len(parts) >= 3 and parts[-3] == "concepts":
+            return 200, {"conceptDescriptions": self.descriptions(parts[-2])}
+        if parts[-1] == "descriptions":
+            items = [description for concept_id in query.get("conceptIds", []) for description in self.descriptions(concept_id)]
+            return 200, {"items": items, "total": len(items)}
+        if len(parts) >= 2 and parts[-2] == "concepts":
+            return 200, self.concept(parts[-1])
+        return 404, {"message": f"Unknown Snowstorm path {path}"}
+
+    def _internal_tools(self, method, path, body):
+        if path.endswith("/versions/most_recent"):
+            return 200, {"uuid": str(uuid.uuid4()), "status": "active"}
+        if path.endswith("/actions/new_version_from_previous"):
+            return 200, {"new_version_uuid": str(uuid.uuid4())}
+        if path.endswith("/sources"):
+            return 200, [str(uuid.uuid4()) for _ in body]
+        if method == "POST":
+            return 200, {}
+        return 404, {"message": f"Unknown infx-internal path {path}"}
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive like the real upstreams, so the client's connection pool is exercised
+            protocol_version = "HTTP/1.1"
+
+            def _respond(self, method):
+                url = urlparse(self.path)
+                body = None
+                if method == "POST":
+                    length = int(self.headers.get("Content-Length") or 0)
+                    body = json.loads(self.rfile.read(length) or b"null")
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+                if url.path.startswith(SNOWSTORM_PREFIX):
+                    upstream._count("snowstorm")
+                    status, payload = upstream._snowstorm(url.path[len(SNOWSTORM_PREFIX):], parse_qs(url.query))
+                else:
+                    upstream._count("infx-internal")
+                    status, payload = upstream._internal_tools(method, url.path[len(INTERNAL_TOOLS_PREFIX):], body)
+                if upstream._should_fail():
+                    status, payload = 503, {"message": "Injected error"}
+                encoded = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
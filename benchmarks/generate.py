@@ -0,0 +1,78 @@
+import json
+import random
+import sys
+
+SIZES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+SNOMED_SYSTEMS = ["http://snomed.info/sct", "urn:oid:2.16.840.1.113883.6.96"]
+# Share of generated conditions that get a SNOMED code of their own instead of repeating a sample code
+DEFAULT_NEW_CODE_FRACTION = 0.2
+
+
+def _vary_text(text, rng):
+    variation = rng.random()
+    if variation < 0.5:
+        return text
+    if variation < 0.6:
+        return text.lower()
+    if variation < 0.7:
+        return f"{text}, NOS"
+    if variation < 0.8:
+        return text.replace("neoplasm", "tumor").replace("Neoplasm", "Tumor")
+    if variation < 0.9 and len(text) > 4:
+        # a typo: drop one character
+        position = rng.randrange(1, len(text) - 1)
+        return text[:position] + text[position + 1:]
+    return f"{text} "
+
+
+def generate_conditions(samples, count, new_code_fraction=DEFAULT_NEW_CODE_FRACTION, seed=0):
+    """
+    Lazily generates synthetic conditions shaped like sample_data.json by varying the sample conditions.
+
+    Most conditions repeat a sample with its text varied (case, ", NOS", synonyms, typos, whitespace), as
+    the nightly input repeats earlier pairs. A share gets a new SNOMED code, which the fake upstream
+    synthesizes a concept for, and some lose their SNOMED coding so only the text is left.
+
+    Args:
+        samples (list): Conditions shaped like sample_data.json.
+        count (int): Number of conditions to generate.
+        new_code_fraction (float): Share of conditions with a new SNOMED code (default: DEFAULT_NEW_CODE_FRACTION).
+        seed (int): Random seed, so runs are comparable (default: 0).
+
+    Yields:
+        dict: One condition at a time.
+    """
+    rng = random.Random(seed)
+    for number in range(count):
+        sample = samples[rng.randrange(len(samples))]
+        coding = [dict(item) for item in sample["coding"]]
+        text = _vary_text(sample["text"], rng)
+        draw = rng.random()
+        if draw < new_code_fraction:
+            code = str(900000000000 + number)
+            text = f"Synthetic condition {code}"
+            for item in coding:
+                if item["system"] in SNOMED_SYSTEMS:
+                    item["code"] = code
+                    item["display"] = f"{text} (disorder)"
+        elif draw < new_code_fraction + 0.05:
+            coding = [item for item in coding if item["system"] not in SNOMED_SYSTEMS]
+        yield {"coding": coding, "text": text}
+
+
+def write_conditions(path, conditions):
+    """
+    Writes conditions to an NDJSON file, one per line, without holding them in memory.
+    """
+    with open(path, "w") as output_file:
+        for condition in conditions:
+            output_file.write(json.dumps(condition) + "\n")
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.generate <1k|100k|1m|count> <output.ndjson> [sample_data.json]
+    size = sys.argv[1]
+    sample_path = sys.argv[3] if len(sys.argv) > 3 else "sample_data.json"
+    with open(sample_path) as sample_file:
+        samples = json.load(sample_file)
+    write_conditions(sys.argv[2], generate_conditions(samples, SIZES.get(size.lower()) or int(size)))
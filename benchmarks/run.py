@@ -0,0 +1,226 @@
+"""
+Benchmarks the matching pipeline against a local stand-in for Snowstorm and infx-internal.
+
+    python -m benchmarks.run --size 100k --latency 0.02 --error-rate 0.01
+
+Conditions are generated (see benchmarks.generate) into an NDJSON file, or read from --input, and every
+stage is run over the whole input in turn:
+
+    resolve   bulk Snowstorm lookups of each batch (models.snowstorm.resolve_batch)
+    index     adding the batch's concepts to the term index (automapping.index_concepts)
+    match     matching (code, text) pairs through every tier (automapping.match_codes)
+    pipeline  deciding each condition and queueing its map write (main.process_condition), then
+              writing the concept maps
+
+For each stage it reports throughput, p50/p99 latency, upstream HTTP calls per condition, the resident
+memory of the process at the end of the stage and how much it grew during the stage; the --json file also
+gets the stage's instrumentation summary (see models.metrics). The resolve, index and match stages work on
+a whole batch at once, so their latencies are per batch of --batch-size conditions; the pipeline stage's
+are per condition (the latency_per column says which).
+Caches stay warm from one stage to the next unless --cold is given.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from array import array
+from urllib.parse import urlparse
+
+import automapping
+import main
+from benchmarks.fake_upstream import FakeUpstream, concepts_from_conditions
+from benchmarks.generate import SIZES, generate_conditions, write_conditions
+from models import http_client, snowstorm
+from models.concept_cache import CONCEPT_CACHE
+from models.concept_map_writer import ConceptMapWriter
+from models.concurrency import DEFAULT_MAX_WORKERS, map_concurrently, set_rate_limit
+from models.ingestion import batched, read_conditions
+from models.metrics import METRICS
+from models.snowstorm import collect_snomed_codes, resolve_batch
+
+STAGES = ["resolve", "index", "match", "pipeline"]
+# What one latency sample of a stage covers
+LATENCY_UNITS = {"resolve": "batch", "index": "batch", "match": "batch", "pipeline": "condition"}
+BATCH_SIZE = 1000
+# High enough that the client-side rate limit never throttles the local stand-in
+LOCAL_RATE_LIMIT = 100000
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_mb():
+    """
+    Current resident memory of the process, or None where /proc is not available. Unlike ru_maxrss, the
+    process's high-water mark, it can be compared from one stage to the next.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def snomed_pairs(batch):
+    pairs = []
+    for condition in batch:
+        codes = main.filter_non_snomed_codes(condition["coding"])
+        if codes:
+            pairs.append((codes[0], condition["text"]))
+    return pairs
+
+
+def run_resolve(batch, max_workers):
+    started = time.perf_counter()
+    resolve_batch(batch)
+    return [time.perf_counter() - started]
+
+
+def run_index(batch, max_workers):
+    started = time.perf_counter()
+    automapping.index_concepts(collect_snomed_codes(batch))
+    return [time.perf_counter() - started]
+
+
+def run_match(batch, max_workers):
+    pairs = snomed_pairs(batch)
+    started = time.perf_counter()
+    automapping.match_codes(pairs, max_workers=max_workers)
+    return [time.perf_counter() - started]
+
+
+def run_pipeline(batch, max_workers):
+    def timed(condition):
+        started = time.perf_counter()
+        main.process_condition(condition)
+        return time.perf_counter() - started
+
+    return list(map_concurrently(timed, batch, max_workers))
+
+
+STAGE_FUNCTIONS = {
+    "resolve": run_resolve,
+    "index": run_index,
+    "match": run_match,
+    "pipeline": run_pipeline,
+}
+
+
+def reset_caches():
+    CONCEPT_CACHE.clear()
+    automapping._term_indexes.clear()
+    automapping._candidate_finders.clear()
+    automapping._fuzzy_matchers.clear()
+
+
+def run_stage(stage, input_path, upstream, batch_size, max_workers):
+    """
+    Runs one stage over the whole input and returns its measurements.
+    """
+    stage_function = STAGE_FUNCTIONS[stage]
+    METRICS.reset()
+    requests_before = sum(upstream.requests.values())
+    rss_before = rss_mb()
+    latencies = array("d")
+    conditions = 0
+    started = time.perf_counter()
+    for batch in batched(read_conditions(input_path), batch_size):
+        latencies.extend(stage_function(batch, max_workers))
+        conditions += len(batch)
+    if stage == "pipeline":
+        main.concept_map_writer.flush()
+    elapsed = time.perf_counter() - started
+    calls = sum(upstream.requests.values()) - requests_before
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    rss_after = rss_mb()
+    return {
+        "stage": stage,
+        "conditions": conditions,
+        "seconds": elapsed,
+        "conditions_per_second": conditions / elapsed if elapsed else None,
+        "latency_per": LATENCY_UNITS[stage],
+        "p50_ms": p50 * 1000 if p50 is not None else None,
+        "p99_ms": p99 * 1000 if p99 is not None else None,
+        "http_calls": calls,
+        "http_calls_per_condition": calls / conditions if conditions else None,
+        "rss_mb": rss_after,
+        "rss_delta_mb": rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+        "metrics": METRICS.summary(),
+    }
+
+
+def configure(upstream, max_workers):
+    """
+    Points the Snowstorm lookups and the concept map writes at the local stand-in.
+    """
+    snowstorm.SNOWSTORM_BASE_URL = upstream.snowstorm_url
+    main.INTERNAL_TOOLS_BASE_URL = upstream.internal_tools_url
+    main.CONCEPT_MAP_UUID = "benchmark"
+    main.concept_map_writer = ConceptMapWriter(upstream.internal_tools_url)
+    set_rate_limit(urlparse(upstream.base_url).hostname, LOCAL_RATE_LIMIT)
+    http_client.set_pool_size(max_workers)
+
+
+def print_report(results):
+    columns = ["stage", "conditions", "seconds", "conditions_per_second", "latency_per", "p50_ms", "p99_ms",
+               "http_calls_per_condition", "rss_mb", "rss_delta_mb"]
+    print("  ".join(f"{column:>24}" for column in columns))
+    for result in results:
+        print("  ".join(
+            f"{result[column]:>24.3f}" if isinstance(result[column], float) else f"{str(result[column]):>24}"
+            for column in columns
+        ))
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the matching pipeline against a local Snowstorm stand-in.")
+    parser.add_argument("--size", default="1k", help="1k, 100k, 1m or a number of conditions to generate")
+    parser.add_argument("--input", help="NDJSON or JSON conditions to use instead of generating them")
+    parser.add_argument("--samples", default="sample_data.json", help="conditions the generated ones are based on")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every upstream response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream requests failing with 503")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="concurrent workers per stage")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma-separated stages to run, in order")
+    parser.add_argument("--cold", action="store_true", help="clear the caches and term indexes before each stage")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    upstream = FakeUpstream(concepts_from_conditions(args.samples), args.latency, args.error_rate).start()
+    configure(upstream, args.workers)
+    input_path = args.input
+    generated = None
+    try:
+        if input_path is None:
+            with open(args.samples) as sample_file:
+                samples = json.load(sample_file)
+            count = SIZES.get(args.size.lower()) or int(args.size)
+            descriptor, input_path = tempfile.mkstemp(suffix=".ndjson")
+            os.close(descriptor)
+            generated = input_path
+            write_conditions(input_path, generate_conditions(samples, count))
+
+        results = []
+        for stage in args.stages.split(","):
+            if args.cold:
+                reset_caches()
+            results.append(run_stage(stage, input_path, upstream, args.batch_size, args.workers))
+        print_report(results)
+        if args.json:
+            with open(args.json, "w") as output_file:
+                json.dump(results, output_file, indent=2)
+    finally:
+        upstream.stop()
+        if generated:
+            os.remove(generated)
+    return results
+
+
+if __name__ == "__main__":
+    main_benchmark()
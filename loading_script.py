@@ -1,8 +1,21 @@
 import csv
 import json
+import os
+import threading
+
 import requests
 
+from models import http_client
+from models.concurrency import map_concurrently
+from models.ingestion import batched
+
 INTERNAL_TOOLS_BASE_URL = "http://127.0.0.1:5000"
+BATCH_SIZE = 100
+MAX_WORKERS = 4
+# Row numbers of the CSV rows the API has acknowledged, one per line; a rerun skips them
+CHECKPOINT_FILE = 'new_code_checkpoint.txt'
+CSV_FILE = 'mda_condiditions_export_13_mar_2023.csv'
+PANDAS_CHUNK_SIZE = 10000
 
 # Load CSV file
 # Add new codes to MDA Conditions Terminology V2 (terminology_uuid = d49cabaa-f31c-473c-a059-59b6b7ee2bb7)
@@ -15,29 +28,118 @@ def load_from_csv(filename):
     :param filename: name of the CSV file
     :return: A list of dictionaries
     """
-    with open(filename) as input_file:
-        csvreader = csv.DictReader(input_file)
-        output = []
-        for row in csvreader:
-            output.append({
+    return [new_code for _, new_code in iter_new_codes(filename)]
+
+
+def iter_new_codes(filename, use_pandas=False, chunk_size=PANDAS_CHUNK_SIZE):
+    """
+    Streams the new codes of the specified CSV file, parsing and validating one row at a time,
+    so memory stays flat and the first batch can be posted before the whole file is read
+    :param filename: name of the CSV file
+    :param use_pandas: read the file in chunks with pandas, which is faster for very large exports
+    :param chunk_size: number of rows per pandas chunk
+    :return: A generator of (row number, new code) tuples; invalid rows are reported and skipped
+    """
+    rows = _iter_pandas_rows(filename, chunk_size) if use_pandas else _iter_csv_rows(filename)
+    for row_number, row in enumerate(rows):
+        try:
+            yield row_number, {
                 "code": row["display"],
                 "display": row["code"],
                 "terminology_version_uuid": "d49cabaa-f31c-473c-a059-59b6b7ee2bb7",
                 "additional_data": json.loads(row["additional_data"]),
-            })
-        return output
-
-
-def main():
-    new_codes = load_from_csv('mda_condiditions_export_13_mar_2023.csv')
-    print(new_codes[0])
-    print('Total codes:', len(new_codes))
-    for index, new_code in enumerate(new_codes[5000:]):
-        # Post request to insert new code API
-        response = requests.post(f'{INTERNAL_TOOLS_BASE_URL}/terminology/new_code', json=[new_code])
-        print(index, new_code['code'], response)
-        if response.status_code == 400:
-            print(response.json())
+            }
+        except (KeyError, TypeError, ValueError) as error:
+            print('Skipping invalid row', row_number, repr(error))
+
+
+def _iter_csv_rows(filename):
+    with open(filename, newline='') as input_file:
+        yield from csv.DictReader(input_file)
+
+
+def _iter_pandas_rows(filename, chunk_size):
+    import pandas as pd
+
+    for chunk in pd.read_csv(filename, chunksize=chunk_size, dtype=str, keep_default_na=False):
+        yield from chunk.to_dict('records')
+
+
+def read_checkpoint(filename=CHECKPOINT_FILE):
+    """
+    Returns the row numbers already acknowledged by a previous run
+    :param filename: name of the checkpoint file
+    :return: A set of row numbers
+    """
+    if not os.path.exists(filename):
+        return set()
+    with open(filename) as checkpoint_file:
+        return {int(line) for line in checkpoint_file if line.strip()}
+
+
+def post_batch(rows):
+    """
+    Posts a batch of new codes to the insert new code API. If the API rejects the batch with a 400,
+    the batch is split in halves and each half is retried, down to single rows, so only the failing
+    rows are left out. A POST that timed out or lost its connection is not retried, since the rows may
+    have been inserted; they are reported as failed and left out of the checkpoint.
+    :param rows: A list of (row number, new code) tuples
+    :return: The row numbers that were acknowledged and the row numbers that failed
+    """
+    try:
+        response = http_client.post(
+            f'{INTERNAL_TOOLS_BASE_URL}/terminology/new_code',
+            json=[new_code for _, new_code in rows],
+        )
+    except (requests.ConnectionError, requests.Timeout) as error:
+        print(f'Rows {rows[0][0]} to {rows[-1][0]}', error)
+        return [], [row_number for row_number, _ in rows]
+    if response.status_code == 200:
+        return [row_number for row_number, _ in rows], []
+    if response.status_code == 400 and len(rows) > 1:
+        middle = len(rows) // 2
+        first_acknowledged, first_failed = post_batch(rows[:middle])
+        second_acknowledged, second_failed = post_batch(rows[middle:])
+        return first_acknowledged + second_acknowledged, first_failed + second_failed
+    if len(rows) == 1:
+        row_number, new_code = rows[0]
+        print(row_number, new_code['code'], response)
+    else:
+        print(f'Rows {rows[0][0]} to {rows[-1][0]}', response)
+    if response.status_code == 400:
+        print(response.json())
+    return [], [row_number for row_number, _ in rows]
+
+
+def main(use_pandas=False):
+    acknowledged = read_checkpoint(CHECKPOINT_FILE)
+    print('Already loaded:', len(acknowledged))
+    pending = (
+        (row_number, new_code) for row_number, new_code in iter_new_codes(CSV_FILE, use_pandas)
+        if row_number not in acknowledged
+    )
+    loaded = 0
+    failed = []
+    checkpoint_lock = threading.Lock()
+    with open(CHECKPOINT_FILE, 'a') as checkpoint_file:
+
+        def post_and_checkpoint(rows):
+            # checkpoints a batch as soon as it is posted: map_concurrently hands results back in input
+            # order, so a slow batch would otherwise hold back the rows acknowledged after it
+            batch_acknowledged, batch_failed = post_batch(rows)
+            with checkpoint_lock:
+                checkpoint_file.writelines(f'{row_number}\n' for row_number in batch_acknowledged)
+                checkpoint_file.flush()
+            return batch_acknowledged, batch_failed
+
+        for batch_acknowledged, batch_failed in map_concurrently(
+            post_and_checkpoint, batched(pending, BATCH_SIZE), MAX_WORKERS
+        ):
+            loaded += len(batch_acknowledged)
+            failed.extend(batch_failed)
+            print('Loaded', len(batch_acknowledged), 'failed', len(batch_failed))
+    print('Total loaded:', loaded)
+    print('Failed rows:', failed)
 
 if __name__ == "__main__":
     main()
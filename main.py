@@ -1,9 +1,53 @@
-import requests
+import argparse
 import json
+from decouple import config
 from flask import Flask, jsonify, request, Response
 
+from automapping import (
+    decision_release, find_candidates, get_fuzzy_matcher, get_term_index, index_concepts,
+    load_substitutes, load_term_index, match_code, match_codes, match_text, normalize_synonyms,
+)
+from models import http_client
+from models.concept_map_writer import ConceptMapWriter
+from models.concurrency import DEFAULT_MAX_WORKERS, map_concurrently
+from models.decision_store import DecisionStore
+from models.ingestion import batched, read_conditions
+from models.manual_queue import ManualMappingQueue
+from models.metrics import METRICS, JsonSummaryExporter, PrometheusExporter, profiled
+from models.micro_batcher import MicroBatcher
+from models.records import MatchResult
+from models.snowstorm import SNOMED_SYSTEMS, SnowstormError, resolve_batch, use_cache_store, use_rf2_index
+
 INTERNAL_TOOLS_BASE_URL = "https://infx-internal.prod.projectronin.io"
 SNOWSTORM_BASE_URL = "https://snowstorm.prod.projectronin.io/MAIN"
+DECISION_STORE_FILE = "decisions.sqlite"
+# Concept map that automapped conditions are added to, unless a condition names its own
+CONCEPT_MAP_UUID = config("CONDITIONS_CONCEPT_MAP_UUID", default=None)
+
+MANUAL_QUEUE_FILE = "manual_mapping_queue.csv"
+# Instrumentation: METRICS_JSON_FILE gets a summary at the end of the run, METRICS_PORT serves
+# Prometheus text on /metrics during it, PROFILE_FILE turns on cProfile for the run
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+METRICS_JSON_FILE = config("METRICS_JSON_FILE", default=None)
+METRICS_PORT = config("METRICS_PORT", default=None, cast=lambda value: int(value) if value else None)
+PROFILE_FILE = config("PROFILE_FILE", default=None)
+# CONCEPT_CACHE_DB keeps Snowstorm lookups between runs, for batch runs and the service alike (see snowstorm.use_cache_store)
+CONCEPT_CACHE_DB = config("CONCEPT_CACHE_DB", default=None)
+# RF2_INDEX_FILE: local RF2 index whose historical associations replace matches on inactive concepts
+# (see automapping.load_substitutes)
+RF2_INDEX_FILE = config("RF2_INDEX_FILE", default=None)
+# USE_RF2_INDEX answers every concept lookup from RF2_INDEX_FILE instead of Snowstorm, for network-isolated
+# runs (see snowstorm.use_rf2_index)
+USE_RF2_INDEX = config("USE_RF2_INDEX", default=False, cast=bool)
+SERVICE_PORT = config("PORT", default=8000, cast=int)
+# TERM_INDEX_FILE keeps the concepts indexed for candidate search between runs and starts the service warm
+# (see automapping.load_term_index)
+TERM_INDEX_FILE = config("TERM_INDEX_FILE", default=None)
+
+concept_map_writer = ConceptMapWriter(INTERNAL_TOOLS_BASE_URL)
+manual_mapping_queue = ManualMappingQueue(normalize_synonyms, find_candidates)
+
+app = Flask(__name__)
 
 def filter_non_snomed_codes(coding_array):
     """
@@ -15,120 +59,316 @@ def filter_non_snomed_codes(coding_array):
     filtered_array (list of dict): A list of SNOMED CT codes and their associated text, extracted from the input coding_array.
     If no SNOMED CT codes are found in the input coding_array, returns None.
     """
-    filtered_array = []
-    for coding in coding_array:
-        if coding['system'] in ['http://snomed.info/sct', 'urn:oid:2.16.840.1.113883.6.96']:
-            filtered_array.append(coding['code'])
+    with METRICS.timed("filter_codings"):
+        filtered_array = []
+        for coding in coding_array:
+            if coding['system'] in ['http://snomed.info/sct', 'urn:oid:2.16.840.1.113883.6.96']:
+                filtered_array.append(coding['code'])
     return filtered_array
 
 
 
-def get_preferred_term_and_fully_specified_name(filtered_array):
+def auto_map(condition, result):
     """
-    Check if an incoming coding object is suitable for automatic mapping to a standardized concept in SNOMED CT, by searching
-    for an exact match between the incoming text and the preferred term or fully-specified name of the corresponding SNOMED CT
-    concept. If no exact match is found, returns False and adds the SNOMED CT code to a synonym_check_array for synonym matching.
+    Queues the mapping of an automapped condition to its SNOMED concept. The mappings of a run are written
+    by concept_map_writer in bulk, grouped by concept map, when enough are pending and at the end of the run.
 
     Parameters:
-    filtered_array (dict): A dictionary containing an array of coding objects and a text string.
+    condition (dict): The condition; its "concept_map_uuid", if any, overrides CONCEPT_MAP_UUID.
+    result (MatchResult): The decision for the condition, handed back with its decision key to the
+    writer's on_written once the mapping is stored.
+    """
+    concept_map_writer.add(
+        condition.get("concept_map_uuid", CONCEPT_MAP_UUID),
+        source_concept(condition),
+        {"code": result.matched_code, "display": result.fsn_for_matched_code, "system": "http://snomed.info/sct"},
+        key=(*decision_key(condition), result),
+    )
+
+
+def source_concept(condition):
+    """
+    The source concept of a condition: its serialized codeable concept as the code and its text as the display.
+    """
+    codeable_concept = {"coding": condition["coding"], "text": condition["text"]}
+    return {"code": json.dumps(codeable_concept, sort_keys=True), "display": condition["text"]}
+
+def manual_map(filtered_array, client_display_text, candidates=None):
+    """
+    Queues a condition that could not be automapped for manual mapping. Occurrences of the same codes and
+    normalized text are counted as one item of manual_mapping_queue, exported at the end of the run.
+
+    Parameters:
+    filtered_array (list): The SNOMED codes supplied with the condition.
+    client_display_text (str): The client text of the condition.
+    candidates (list): Candidate concepts already found for the text, if any.
+    """
+    manual_mapping_queue.add(filtered_array, client_display_text, candidates)
+
+
+def process_condition(condition, decisions=None):
+    """
+    Decides whether a single condition can be automapped and sends it to auto_map or manual_map.
+
+    Parameters:
+    condition (dict): A condition with a "coding" array and the client "text".
+    decisions (DecisionStore): If given, a condition decided in an earlier run is not matched again (it is queued for manual
+    mapping again if it had no match), and new decisions are recorded in it:
+    right away when the condition goes to manual mapping, once its mapping is written when it is automapped (see run_batch).
+    A condition whose concept could not be looked up is left undecided.
 
     Returns:
-    If a match is found and the mapping is successful, returns True.
-    If no match is found, returns False and appends the SNOMED CT code to synonym_check_array.
-    If the input coding array does not contain any SNOMED CT codes, returns None.
-    """
-    sctid = filtered_array[0]
-    pt_fsn_search = requests.get(
-        f"{SNOWSTORM_BASE_URL}/concepts?conceptIds={sctid}",
-    ).json()
-    if pt_fsn_search == {"error": "NOT_FOUND", "message": "Concept not found"}:
-        return None
-    else:
-        first_item = pt_fsn_search["items"][0]
-        pt = first_item["pt"]["term"]
-        fsn = first_item["fsn"]["term"]
-        return fsn, pt
+    True if the condition was automapped, False otherwise.
+    """
+    coding_array = condition["coding"]
+    client_display_text = condition["text"]
+    filtered_array = filter_non_snomed_codes(coding_array)
+
+    if decisions is not None:
+        decided = decisions.get(*decision_key(condition))
+        if decided is not None:
+            if decided.matched_code is None:
+                # the queue is exported afresh every run: it still gets every occurrence of a decided condition
+                manual_map(filtered_array, client_display_text)
+            return decided.matched_code is not None
+
+    try:
+        result = decide_condition(filtered_array, client_display_text)
+    except SnowstormError as error:
+        # not a decision: the condition is decided again on the next run
+        print(f"Could not decide {client_display_text!r}: {error}")
+        METRICS.count("lookup_failures")
+        return False
+    METRICS.count("match_reasons", reason=result.matched_reason or "NO MATCH")
+    if result.matched_code is not None:
+        auto_map(condition, result)
+        return True
+    # without a code, a condition is only compared with the concepts indexed so far, which grow from run
+    # to run: it is not recorded unless it was matched
+    if decisions is not None and filtered_array:
+        decisions.record(*decision_key(condition), result)
+    return False
+
+
+def decision_key(condition):
+    """
+    The (code, display text) pair a condition's decision is stored under: its SNOMED codes and its text.
+    """
+    return ",".join(filter_non_snomed_codes(condition["coding"])), condition["text"]
 
 
-def get_synonyms(filtered_array):
+def decide_condition(filtered_array, client_display_text):
     """
+    Matches the client text against the supplied SNOMED code, or against known concepts when none was supplied.
 
+    Returns:
+    MatchResult of the decision; matched_code is None when the condition goes to manual mapping.
+    """
+    if not filtered_array:
+        # no SNOMED code was supplied: the text is only automapped when it names exactly one known concept
+        result, candidates = match_text(client_display_text)
+        if result.matched_code is None:
+            manual_map(filtered_array, client_display_text, candidates)
+        return result
+
+    if len(filtered_array) > 1:
+        manual_map(filtered_array, client_display_text)
+        return MatchResult(None, None, None, None)
+    # the tiers of the service: a condition is decided the same way in a batch run and by /match
+    result = match_code(filtered_array[0], client_display_text)
+    if result.matched_code is None:
+        manual_map(filtered_array, client_display_text)
+    return result
+
+
+def run_batch(input_path):
+    """
+    Decides every condition of the input file, writes the automapped ones to their concept maps and
+    exports the manual mapping queue.
 
     Parameters:
-    synonym_check_array (dict):
+    input_path (str): Conditions as a JSON array or NDJSON, see models.ingestion.read_conditions.
+    """
+    if RF2_INDEX_FILE and USE_RF2_INDEX:
+        use_rf2_index(RF2_INDEX_FILE)
+    elif CONCEPT_CACHE_DB:
+        use_cache_store(CONCEPT_CACHE_DB)
+    if RF2_INDEX_FILE:
+        load_substitutes(RF2_INDEX_FILE)
+    # Conditions decided in an earlier run against the same release are skipped
+    release = decision_release()
+    decisions = DecisionStore(DECISION_STORE_FILE, "MAIN", release) if release else None
+    if decisions is not None:
+        # automapped conditions are recorded once their mappings are stored, so a run that stops before
+        # the writer flushes decides them again next time
+        def record_written(keys):
+            decisions.record_many(keys)
+            decisions.commit()
+
+        concept_map_writer.on_written = record_written
+    if TERM_INDEX_FILE:
+        load_term_index(TERM_INDEX_FILE)
+    automapped = 0
+    total = 0
+    for batch in batched(read_conditions(input_path)):
+        # resolve the SNOMED codes of the conditions not decided in an earlier run in bulk; the per-condition
+        # lookups below hit the cache. Indexing the resolved concepts lets conditions without a code find them
+        # as candidates.
+        undecided = [
+            condition for condition in batch
+            if decisions is None or decisions.get(*decision_key(condition)) is None
+        ]
+        index_concepts(resolve_batch(undecided))
+        automapped += sum(map_concurrently(lambda condition: process_condition(condition, decisions), batch))
+        total += len(batch)
+        if decisions is not None:
+            decisions.commit()
+    concept_map_writer.flush()
+    if TERM_INDEX_FILE:
+        get_term_index().save(TERM_INDEX_FILE)
+    if decisions is not None:
+        concept_map_writer.on_written = None
+        decisions.close()
+    print(f"Automapped {automapped} of {total} conditions")
+    print(f"Wrote {concept_map_writer.written} mappings, {len(concept_map_writer.failed)} failed")
+    manual_mapping_queue.export(MANUAL_QUEUE_FILE)
+    print(f"Queued {len(manual_mapping_queue)} distinct items for manual mapping in {MANUAL_QUEUE_FILE}")
+
+
+def match_item(entry):
+    """
+    Reads the (SNOMED code, display text) pair to match from one entry of a /match request: a FHIR
+    Condition (its "code"), a CodeableConcept ("coding" and "text") or a single Coding.
 
     Returns:
+    (code, display text); code is None when the entry has no SNOMED coding.
+    """
+    if "code" in entry and isinstance(entry["code"], dict):
+        entry = entry["code"]
+    if "system" not in entry:
+        # a CodeableConcept, possibly with text only, or a Condition without code
+        snomed_codings = [coding for coding in entry.get("coding", []) if coding.get("system") in SNOMED_SYSTEMS]
+        display = entry.get("text") or (snomed_codings[0].get("display") if snomed_codings else None)
+        return (snomed_codings[0]["code"] if snomed_codings else None), display
+    return (entry.get("code") if entry["system"] in SNOMED_SYSTEMS else None), entry.get("display")
+
 
+def match_batch(items):
     """
-    us_en = "900000000000509007"
-    synonym_status = ["ACCEPTABLE", "PREFERRED"]
-    syn_search = requests.get(f"{SNOWSTORM_BASE_URL}/concepts/{filtered_array[0]}/descriptions").json()
-    syn_list = []
-    for item in syn_search["conceptDescriptions"]:
-        if item["type"] == "SYNONYM":
-            if us_en in item["acceptabilityMap"]:
-                if item["acceptabilityMap"][us_en] in synonym_status:
-                    syn_list.append(item["term"])
-    return syn_list
+    Matches a micro-batch of (code, display text) pairs from concurrent /match requests. The concepts of
+    the batch are fetched in bulk; pairs without a SNOMED code are matched on their text alone (see
+    automapping.match_text).
 
-def check_match(client_display_text,list_of_names):
-        if client_display_text in list_of_names:
-            return True
-        else:
-            return False
+    Returns:
+    A MatchResult per pair, in order; a pair without display text has no match. A pair whose concept could
+    not be looked up gets its SnowstormError instead, which fails that entry alone.
+    """
+    coded = [(code, display) for code, display in items if code and display is not None]
+    index_concepts([code for code, _ in coded])
+    coded_results = iter(match_codes(coded, return_exceptions=True))
+    results = []
+    for code, display in items:
+        if display is None:
+            results.append(MatchResult(None, None, None, None))
+            continue
+        if code:
+            results.append(next(coded_results))
+            continue
+        try:
+            results.append(match_text(display)[0])
+        except SnowstormError as error:
+            results.append(error)
+    return results
 
-def auto_map(filtered_array):
-    #  call to add new item into terminology
 
-    if can_automap = True:
-        requests.post(f"{INTERNAL_TOOLS_BASE_URL}/terminology/new_code", json={
+# Coalesces concurrent /match requests; one per process, so every request thread of a worker shares it
+match_batcher = MicroBatcher(match_batch)
 
-        })
-        # if request.status_code == 400:
 
+@app.route("/match", methods=["POST"])
+def match():
+    """
+    Matches one FHIR Condition, CodeableConcept or Coding, or a list of them, and returns the match
+    reason and target of each (a single object for a single entry, else a list in request order).
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return jsonify({"error": "Expected a JSON body"}), 400
+    single = not isinstance(payload, list)
+    try:
+        items = [match_item(entry) for entry in ([payload] if single else payload)]
+    except (AttributeError, KeyError, TypeError) as error:
+        return jsonify({"error": f"Could not read a coding from the request: {error!r}"}), 400
+    with METRICS.timed("service_match"):
+        results = match_batcher.submit(items, return_exceptions=True)
+    # an entry that could not be matched gets an error of its own; the other entries are answered
+    body = [
+        {"code": code, "display": display, "error": f"Could not match: {result!r}"}
+        if isinstance(result, Exception) else {"code": code, "display": display, **result._asdict()}
+        for (code, display), result in zip(items, results)
+    ]
+    if single and isinstance(results[0], Exception):
+        return jsonify(body[0]), 502 if isinstance(results[0], SnowstormError) else 500
+    return jsonify(body[0] if single else body)
 
-    #  does relevant concept map has version currently in draft
 
+@app.route("/metrics")
+def metrics():
+    return Response(METRICS.prometheus_text(), mimetype="text/plain")
 
-    #  if yes, add to map --> 1.create source concept 2.create mapping
-    # most recent version - if in draft, reject; if active, call create new version of value set from previous version
 
+@app.route("/health")
+def health():
+    return jsonify({"status": "ok", "indexed_concepts": len(get_term_index())})
 
-    # if no, create a new version in draft and add the concept
-        requests.post(f"{INTERNAL_TOOLS_BASE_URL}/ConceptMaps/actions/new_version_from_previous", json={
 
-        })
+def create_app():
+    """
+    Warms the concept cache and term index and returns the /match app. This is the WSGI entry point,
+    e.g. gunicorn "main:create_app()" (see the Dockerfile). Requests arriving together are coalesced
+    by match_batcher, so their concepts are fetched and matched in one batch.
+    """
+    METRICS.enabled = METRICS_ENABLED
+    http_client.set_pool_size(DEFAULT_MAX_WORKERS)
+    if RF2_INDEX_FILE and USE_RF2_INDEX:
+        use_rf2_index(RF2_INDEX_FILE)
+    elif CONCEPT_CACHE_DB:
+        use_cache_store(CONCEPT_CACHE_DB)
+    if RF2_INDEX_FILE:
+        load_substitutes(RF2_INDEX_FILE)
+    if TERM_INDEX_FILE:
+        load_term_index(TERM_INDEX_FILE)
+    get_fuzzy_matcher().fit()
+    return app
 
-    pass
 
-def manual_map(filtered_array):
-    # does relevant concept map has version currently in draft
-    # if yes, add to map --> 1.create source concept 2.create mapping
-    # if no, create a new version in draft and add the concept
-    pass
+def start_service(port=SERVICE_PORT):
+    """
+    Serves /match from Flask's development server until stopped, for local use; deployments run
+    create_app under gunicorn.
+    """
+    create_app().run(host="0.0.0.0", port=port, threaded=True)
 
 
 if __name__ == "__main__":
-    # load unresolved errors from the error service
-    # But for now, load from file
-    with open('sample_data.json') as json_input:
-        sample_data = json.load(json_input)
-    for condition in sample_data:
-        coding_array = condition["coding"]
-        client_display_text = condition["text"]
-        filtered_array = filter_non_snomed_codes(coding_array)
-
-        if len(filtered_array) > 1:
-            manual_map(filtered_array)
-        can_automap = False
-        fully_specified_name, preferred_term = get_preferred_term_and_fully_specified_name(filtered_array)
-        if check_match(client_display_text, [fully_specified_name, preferred_term]):
-             can_automap = True
-        else:
-            acceptable_and_preferred_synonyms = get_synonyms(filtered_array)
-            if check_match(client_display_text, acceptable_and_preferred_synonyms):
-                can_automap = True
-        if can_automap is True:
-            auto_map(filtered_array)
-        else:
-            manual_map(filtered_array)
+    # python main.py                    decides the conditions of sample_data.json
+    # python main.py serve [--port N]   runs the /match service
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", nargs="?", choices=["batch", "serve"], default="batch")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--input", default="sample_data.json")
+    args = parser.parse_args()
+
+    METRICS.enabled = METRICS_ENABLED
+    if args.mode == "serve":
+        start_service(args.port)
+    else:
+        # load unresolved errors from the error service
+        # But for now, load from file, streaming it in batches so memory stays flat whatever its size
+        if METRICS_JSON_FILE:
+            METRICS.add_exporter(JsonSummaryExporter(METRICS_JSON_FILE))
+        if METRICS_PORT:
+            METRICS.add_exporter(PrometheusExporter(METRICS, METRICS_PORT))
+        with profiled(PROFILE_FILE):
+            run_batch(args.input)
+        METRICS.export()
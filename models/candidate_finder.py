@@ -0,0 +1,101 @@
+import re
+import threading
+from collections import Counter
+
+DEFAULT_LIMIT = 5
+MIN_SCORE = 0.5
+# Words too common in condition names to narrow down the candidates
+STOP_WORDS = {"of", "the", "and", "or", "in", "on", "with", "without", "to", "by", "due", "disorder", "finding"}
+
+_word_pattern = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text):
+    return set(_word_pattern.findall(text.lower())) - STOP_WORDS
+
+
+def _trigrams(text):
+    words = _word_pattern.findall(text.lower())
+    if not words:
+        return set()
+    padded = f"  {' '.join(words)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CandidateFinder:
+    """
+    Finds candidate SNOMED concepts for display text alone, for conditions that come without a
+    SNOMED code.
+
+    An exact hit on the term index (EXACT, SYNONYM or NORMALIZED DESCRIPTION) is returned first with a
+    score of 1. Otherwise terms are gathered from a word inverted index (falling back to a trigram
+    inverted index when no word is shared, e.g. for misspellings) and ranked by trigram similarity.
+    """
+
+    def __init__(self, term_index):
+        self.term_index = term_index
+        self._terms = []
+        self._term_trigrams = []
+        self._token_postings = {}
+        self._trigram_postings = {}
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Adds the terms indexed in the term index since the last refresh; terms already seen are not
+        rescanned. The concepts of a term are read from the term index when it is matched, so concepts
+        added to an existing term are found too.
+        """
+        with self._lock:
+            for term in self.term_index.new_terms(len(self._terms)):
+                term_id = len(self._terms)
+                trigrams = _trigrams(term)
+                self._terms.append(term)
+                self._term_trigrams.append(trigrams)
+                for token in _tokens(term):
+                    self._token_postings.setdefault(token, []).append(term_id)
+                for trigram in trigrams:
+                    self._trigram_postings.setdefault(trigram, []).append(term_id)
+
+    def find(self, text, limit=DEFAULT_LIMIT, min_score=MIN_SCORE):
+        """
+        Returns ranked candidate concepts for the display text.
+
+        Args:
+            text (str): The display text of the condition.
+            limit (int): Maximum number of candidates returned (default: DEFAULT_LIMIT).
+            min_score (float): Minimum similarity, between 0 and 1, of a near match (default: MIN_SCORE).
+
+        Returns:
+            list: (concept ID, score, matched reason or matched term) tuples, best first. Exact hits on
+            the term index have a score of 1 and their matched reason; near matches carry the
+            description term they were matched on.
+        """
+        candidates = {
+            concept_id: (1.0, matched_reason) for concept_id, matched_reason in self.term_index.lookup(text).items()
+        }
+
+        normalized_text = self.term_index.strip_ignorable(self.term_index.normalize(text))
+        query_trigrams = _trigrams(normalized_text)
+        if query_trigrams:
+            term_ids = set()
+            for token in _tokens(normalized_text):
+                term_ids.update(self._token_postings.get(token, ()))
+            if not term_ids:
+                shared = Counter()
+                for trigram in query_trigrams:
+                    shared.update(self._trigram_postings.get(trigram, ()))
+                term_ids = {term_id for term_id, count in shared.items() if count * 2 >= len(query_trigrams)}
+
+            for term_id in term_ids:
+                term_trigrams = self._term_trigrams[term_id]
+                score = 2 * len(query_trigrams & term_trigrams) / (len(query_trigrams) + len(term_trigrams))
+                if score < min_score:
+                    continue
+                for concept_id in self.term_index.term_concepts(self._terms[term_id]):
+                    if concept_id not in candidates or candidates[concept_id][0] < score:
+                        candidates[concept_id] = (score, self._terms[term_id])
+
+        ranked = sorted(candidates.items(), key=lambda candidate: candidate[1][0], reverse=True)
+        return [(concept_id, score, detail) for concept_id, (score, detail) in ranked[:limit]]
@@ -0,0 +1,200 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from models.metrics import METRICS
+
+DEFAULT_MAX_ENTRIES = 10000
+# Entries are invalidated when the branch release changes (see set_release), not after a set time
+DEFAULT_TTL_SECONDS = None
+# Cached in place of the payload of a concept that does not exist, so it is not requested again
+NOT_FOUND = object()
+
+
+class ConceptCache:
+    """
+    Cache of Snowstorm lookups shared by every concept lookup in the repo.
+
+    Entries live in an in-memory LRU. When a database path is given the entries are also written to
+    an SQLite file keyed by branch + conceptId, so a later run starts warm. Entries are tagged with the
+    release of their branch and dropped once set_release reports another one; an optional TTL can expire
+    them as well. Concepts that do not exist are cached too (NOT_FOUND).
+    `kind` separates the different payloads we keep for one concept (concept data, descriptions).
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS, db_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._releases = {}
+        self._lock = threading.RLock()
+        self._db = None
+        if db_path:
+            self.attach_store(db_path)
+
+    def attach_store(self, db_path):
+        """
+        Backs the cache with an SQLite file, creating the table if needed.
+
+        Args:
+            db_path (str): Path of the SQLite database file.
+        """
+        with self._lock:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS concept_cache (
+                    branch TEXT NOT NULL,
+                    concept_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    release TEXT,
+                    PRIMARY KEY (branch, concept_id, kind)
+                )
+                """
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(concept_cache)")}
+            if "release" not in columns:
+                self._db.execute("ALTER TABLE concept_cache ADD COLUMN release TEXT")
+            self._db.commit()
+
+    def set_release(self, branch, release):
+        """
+        Records the current release of a branch (see models.snowstorm.get_release). Entries of the branch
+        cached from another release are no longer returned, and are deleted from the SQLite store. With an
+        unknown release (None), only entries cached while the release was unknown are used.
+
+        Args:
+            branch (str): The branch of the concepts repository.
+            release (str): The release key of the branch, or None if it could not be fetched.
+        """
+        with self._lock:
+            self._releases[branch] = release
+            for key in [key for key, entry in self._entries.items() if key[0] == branch and entry[2] != release]:
+                del self._entries[key]
+            if self._db is not None and release is not None:
+                self._db.execute(
+                    "DELETE FROM concept_cache WHERE branch = ? AND (release IS NULL OR release != ?)",
+                    (branch, release),
+                )
+                self._db.commit()
+
+    def _is_expired(self, fetched_at):
+        return self.ttl_seconds is not None and time.time() - fetched_at > self.ttl_seconds
+
+    def _remember(self, key, payload, fetched_at, release):
+        self._entries[key] = (payload, fetched_at, release)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, branch, kind, concept_id):
+        """
+        Returns the cached payload for a concept, NOT_FOUND if the concept is known not to exist, or None
+        if it is not cached (or expired, or cached from another release).
+        """
+        key = (branch, str(concept_id), kind)
+        with self._lock:
+            release = self._releases.get(branch)
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, fetched_at, entry_release = entry
+                if not self._is_expired(fetched_at) and entry_release == release:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT payload, fetched_at FROM concept_cache "
+                    "WHERE branch = ? AND concept_id = ? AND kind = ? AND release IS ?",
+                    key + (release,),
+                ).fetchone()
+                if row is not None and not self._is_expired(row[1]):
+                    payload = json.loads(row[0])
+                    if payload is None:
+                        payload = NOT_FOUND
+                    self._remember(key, payload, row[1], release)
+                    self.hits += 1
+                    return payload
+
+            self.misses += 1
+            return None
+
+    def put(self, branch, kind, concept_id, payload):
+        """
+        Stores a payload for a concept (NOT_FOUND for one that does not exist) in memory and, if attached,
+        in the SQLite store.
+        """
+        self.put_many(branch, kind, {concept_id: payload})
+
+    def put_many(self, branch, kind, payloads):
+        """
+        Stores the payloads of many concepts at once, committing the SQLite store a single time.
+
+        Args:
+            branch (str): The branch of the concepts repository.
+            kind (str): Which payload is stored, e.g. "concept" or "descriptions".
+            payloads (dict): Concept ID to payload, or to NOT_FOUND.
+        """
+        fetched_at = time.time()
+        with self._lock:
+            release = self._releases.get(branch)
+            for concept_id, payload in payloads.items():
+                self._remember((branch, str(concept_id), kind), payload, fetched_at, release)
+            if self._db is not None:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO concept_cache (branch, concept_id, kind, payload, fetched_at, release) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (branch, str(concept_id), kind, json.dumps(None if payload is NOT_FOUND else payload),
+                         fetched_at, release)
+                        for concept_id, payload in payloads.items()
+                    ],
+                )
+                self._db.commit()
+
+    def get_or_fetch(self, branch, kind, concept_id, fetch):
+        """
+        Returns the cached payload for a concept, calling `fetch` to load it on a miss. A concept that does
+        not exist (fetch returning None) is cached as NOT_FOUND; a lookup that raises is not cached.
+
+        Args:
+            branch (str): The branch of the concepts repository.
+            kind (str): Which payload to look up, e.g. "concept" or "descriptions".
+            concept_id (str): The SNOMED concept ID.
+            fetch (callable): Zero-argument function that loads the payload from Snowstorm.
+
+        Returns:
+            The payload, or None if the concept does not exist.
+        """
+        payload = self.get(branch, kind, concept_id)
+        if payload is None:
+            payload = fetch()
+            self.put(branch, kind, concept_id, NOT_FOUND if payload is None else payload)
+        return None if payload is NOT_FOUND else payload
+
+    def hit_ratio(self):
+        """
+        Returns the share of lookups answered from the cache, or None before the first lookup.
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM concept_cache")
+                self._db.commit()
+
+
+# Shared by all Snowstorm lookups; see models.snowstorm.use_cache_store to keep it between runs
+CONCEPT_CACHE = ConceptCache()
+METRICS.register_gauge("cache_hit_ratio", CONCEPT_CACHE.hit_ratio, cache="concept")
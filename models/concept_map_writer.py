@@ -0,0 +1,171 @@
+import threading
+
+import requests
+
+from models import http_client
+from models.ingestion import batched
+from models.metrics import METRICS
+
+# Concept map versions in this status can still be edited
+DRAFT_STATUS = "pending"
+NEW_VERSION_DESCRIPTION = "Automapped conditions"
+# Mappings sent in one bulk request
+WRITE_BATCH_SIZE = 100
+# A concept map's collected mappings are written once this many are pending
+FLUSH_SIZE = 1000
+SNOMED_SYSTEM = "http://snomed.info/sct"
+
+
+class ConceptMapWriter:
+    """
+    Collects the automapped results of a run and writes them to infx-internal grouped by concept map.
+
+    The draft version of each concept map is looked up once per run, and created from the most recent
+    version if that one is not a draft. Source concepts and their mappings are then created in bulk
+    requests of WRITE_BATCH_SIZE, instead of checking versions and posting once per condition. The same
+    source concept added several times is only written once. Callers learn which mappings were written
+    through `on_written`, so they can record them only once they are stored.
+    """
+
+    def __init__(self, base_url, flush_size=FLUSH_SIZE, on_written=None):
+        """
+        Args:
+            base_url (str): Base URL of infx-internal.
+            flush_size (int): Number of pending mappings of a concept map that triggers writing them (default: FLUSH_SIZE).
+            on_written (callable): Called with the keys of every batch of mappings written (default: None).
+        """
+        self.base_url = base_url
+        self.flush_size = flush_size
+        self.on_written = on_written
+        self.written = 0
+        self.failed = []
+        self._pending = {}
+        self._draft_versions = {}
+        self._lock = threading.Lock()
+        self._version_lock = threading.Lock()
+
+    def add(self, concept_map_uuid, source, target, key=None):
+        """
+        Queues a mapping. Safe to call from several threads.
+
+        Args:
+            concept_map_uuid (str): The concept map the mapping belongs to.
+            source (dict): The source concept: "code" and "display".
+            target (dict): The target concept: "code", "display" and "system".
+            key: Passed to on_written once the mapping is written, or listed in `failed` if it could not
+                be (default: None).
+        """
+        with self._lock:
+            pending = self._pending.setdefault(concept_map_uuid, {})
+            pending.setdefault((source["code"], source["display"]), (source, target, key))
+            ready = None
+            if len(pending) >= self.flush_size:
+                ready = list(self._pending.pop(concept_map_uuid).values())
+        if ready:
+            self._write(concept_map_uuid, ready)
+
+    def flush(self):
+        """
+        Writes every pending mapping.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for concept_map_uuid, mappings in pending.items():
+            self._write(concept_map_uuid, list(mappings.values()))
+
+    def get_draft_version(self, concept_map_uuid):
+        """
+        Returns the UUID of the concept map's draft version, creating it from the most recent version if
+        needed. The answer is kept for the life of the writer, so each map is checked once per run.
+
+        Returns:
+            str: The draft version UUID, or None if it could not be found or created.
+        """
+        with self._version_lock:
+            if concept_map_uuid not in self._draft_versions:
+                self._draft_versions[concept_map_uuid] = self._find_or_create_draft(concept_map_uuid)
+            return self._draft_versions[concept_map_uuid]
+
+    def _find_or_create_draft(self, concept_map_uuid):
+        if concept_map_uuid is None:
+            print("No concept map given for automapped conditions, set CONDITIONS_CONCEPT_MAP_UUID")
+            return None
+        try:
+            response = http_client.get(f"{self.base_url}/ConceptMaps/{concept_map_uuid}/versions/most_recent")
+        except requests.RequestException as error:
+            print(f"Error fetching the most recent version of concept map {concept_map_uuid}: {error}")
+            return None
+        if response.status_code != 200:
+            print(f"Error fetching the most recent version of concept map {concept_map_uuid}: {response.status_code}")
+            return None
+        version = response.json()
+        if version["status"] == DRAFT_STATUS:
+            return version["uuid"]
+
+        # http_client does not retry a POST that may have reached the server, so at most one draft is created
+        try:
+            response = http_client.post(
+                f"{self.base_url}/ConceptMaps/actions/new_version_from_previous",
+                json={"previous_version_uuid": version["uuid"], "new_version_description": NEW_VERSION_DESCRIPTION},
+            )
+        except requests.RequestException as error:
+            print(f"Error creating a draft version of concept map {concept_map_uuid}: {error}")
+            return None
+        if response.status_code != 200:
+            print(f"Error creating a draft version of concept map {concept_map_uuid}: {response.status_code}")
+            return None
+        return response.json()["new_version_uuid"]
+
+    def _write(self, concept_map_uuid, mappings):
+        version_uuid = self.get_draft_version(concept_map_uuid)
+        if version_uuid is None:
+            self._fail(mappings)
+            return
+        for batch in batched(mappings, WRITE_BATCH_SIZE):
+            with METRICS.timed("map_writes"):
+                self._write_batch(version_uuid, batch)
+
+    def _write_batch(self, version_uuid, batch):
+        try:
+            self._post_batch(version_uuid, batch)
+        except requests.RequestException as error:
+            print(f"Error writing {len(batch)} mappings to {version_uuid}: {error}")
+            self._fail(batch)
+
+    def _post_batch(self, version_uuid, batch):
+        response = http_client.post(
+            f"{self.base_url}/ConceptMaps/{version_uuid}/sources",
+            json=[source for source, _, _ in batch],
+        )
+        if response.status_code != 200:
+            print(f"Error creating {len(batch)} source concepts in {version_uuid}: {response.status_code}")
+            self._fail(batch)
+            return
+        source_uuids = response.json()
+        response = http_client.post(
+            f"{self.base_url}/mappings/",
+            json=[
+                {
+                    "source_concept_uuid": source_uuid,
+                    "relationship_code": "equivalent",
+                    "target_concept_code": target["code"],
+                    "target_concept_display": target["display"],
+                    "target_concept_system": target.get("system", SNOMED_SYSTEM),
+                }
+                for source_uuid, (_, target, _) in zip(source_uuids, batch)
+            ],
+        )
+        if response.status_code != 200:
+            print(f"Error creating {len(batch)} mappings in {version_uuid}: {response.status_code}")
+            self._fail(batch)
+            return
+        METRICS.count("map_writes", len(batch), result="written")
+        with self._lock:
+            self.written += len(batch)
+        if self.on_written is not None:
+            self.on_written([key for _, _, key in batch])
+
+    def _fail(self, mappings):
+        METRICS.count("map_writes", len(mappings), result="failed")
+        with self._lock:
+            self.failed.extend(key for _, _, key in mappings)
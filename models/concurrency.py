@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+DEFAULT_MAX_WORKERS = 8
+
+# Requests per second allowed against each upstream host
+HOST_RATE_LIMITS = {
+    "snowstorm.prod.projectronin.io": 20,
+    "interop-validation.prod.projectronin.io": 10,
+    "infx-internal.prod.projectronin.io": 10,
+}
+DEFAULT_RATE_LIMIT = 10
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: allows `rate` acquisitions per second on average, with bursts of up
+    to `capacity`. Safe to share between threads.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(host):
+    """
+    Returns the token bucket shared by all requests to the given host.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(host)
+        if bucket is None:
+            bucket = _buckets[host] = TokenBucket(HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT))
+        return bucket
+
+
+def set_rate_limit(host, rate, capacity=None):
+    """
+    Overrides the rate limit (requests per second) for an upstream host.
+    """
+    with _buckets_lock:
+        HOST_RATE_LIMITS[host] = rate
+        _buckets[host] = TokenBucket(rate, capacity)
+
+
+def throttle(url):
+    """
+    Waits until a request to the host of `url` is allowed by that host's rate limit.
+    """
+    get_bucket(urlparse(url).hostname).acquire()
+
+
+def map_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Applies `func` to every item on a bounded thread pool and yields the results in input order.
+
+    At most `max_workers` calls run at once and only a few more items than that are read ahead from
+    `items`, so it can be fed from a lazy iterable of any size. An exception raised by `func` is
+    re-raised when its result is reached.
+
+    Args:
+        func (callable): Function called with one item.
+        items (iterable): The inputs.
+        max_workers (int): Maximum number of concurrent calls (default: DEFAULT_MAX_WORKERS).
+            With 1, items are processed sequentially on the calling thread.
+
+    Yields:
+        The result of `func` for each item, in the order of `items`.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,11 +1,29 @@
 import json
+import threading
+import time
 from decouple import config
 from dataclasses import dataclass, field
 
 from requests.exceptions import HTTPError
-import requests
 
-def get_access_token():
+from models import http_client
+from models.concurrency import DEFAULT_MAX_WORKERS, map_concurrently
+from models.records import Coding
+
+INTEROP_VALIDATION_BASE_URL = "https://interop-validation.prod.projectronin.io"
+RESOURCES_PAGE_SIZE = 100
+# Statuses of the resources still waiting for a fix
+UNRESOLVED_STATUSES = ["REPORTED"]
+# Tokens are refreshed in the background this long before they expire, and synchronously
+# half this long before they expire if the background refresh did not succeed
+TOKEN_REFRESH_MARGIN_SECONDS = 120
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+
+def request_access_token():
+    """
+    Requests a new Auth0 client-credentials token.
+    @return: the access token and its lifetime in seconds
+    """
     base_url = config("auth0_url")
     payload = {
         "grant_type": "client_credentials",
@@ -13,11 +31,63 @@ def get_access_token():
         "client_secret": config("auth0_client_secret"),
         "audience": config("auth0_audience"),
     }
-    response = requests.post(base_url, data=payload)
-    return response.json()["access_token"]
+    response = http_client.post(base_url, data=payload)
+    response.raise_for_status()
+    token = response.json()
+    return token["access_token"], token.get("expires_in", DEFAULT_TOKEN_LIFETIME_SECONDS)
+
+
+class TokenProvider:
+    """
+    Thread-safe cache of the access token. The token is reused until shortly before it expires and
+    refreshed ahead of time on a background timer, so callers almost never wait for Auth0.
+    """
+
+    def __init__(self, fetch_token=request_access_token, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        self._fetch_token = fetch_token
+        self._refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        with self._lock:
+            if self._token is None or time.time() >= self._expires_at - self._refresh_margin / 2:
+                self._refresh()
+            return self._token
+
+    def _refresh(self):
+        token, expires_in = self._fetch_token()
+        self._token = token
+        self._expires_at = time.time() + expires_in
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if expires_in > self._refresh_margin:
+            self._timer = threading.Timer(expires_in - self._refresh_margin, self._refresh_in_background)
+            self._timer.daemon = True
+            self._timer.start()
 
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as error:
+            # get_token refreshes synchronously once the token gets close to expiring
+            print(f"Error refreshing access token: {error}")
 
-@dataclass
+
+_token_provider = TokenProvider()
+
+def get_access_token():
+    """
+    Returns a valid access token, shared by every request to the validation service.
+    """
+    return _token_provider.get_token()
+
+
+@dataclass(slots=True)
 class Resource:
     id: str
     resource_type: str
@@ -25,6 +95,35 @@ class Resource:
     status: str
     severity: str
     issues: list = field(default_factory=list)
+    codings: tuple = ()
+    text: str = None
+
+    def extract_codings(self, drop_payload=True):
+        """
+        Keeps the codings and text of the Condition code as compact records and, by default, drops the raw
+        FHIR payload, which is most of a resource's memory.
+        @param drop_payload: set resource to None once the codings are extracted
+        """
+        resource = json.loads(self.resource) if isinstance(self.resource, str) else (self.resource or {})
+        codeable_concepts = resource.get("code") or []
+        if isinstance(codeable_concepts, dict):
+            codeable_concepts = [codeable_concepts]
+        self.codings = tuple(
+            Coding(coding.get("system"), coding.get("code"), coding.get("display"))
+            for codeable_concept in codeable_concepts
+            for coding in codeable_concept.get("coding", [])
+        )
+        self.text = resource.get("text") if isinstance(resource.get("text"), str) else next(
+            (codeable_concept["text"] for codeable_concept in codeable_concepts if codeable_concept.get("text")), None
+        )
+        if drop_payload:
+            self.resource = None
+
+    def as_condition(self):
+        """
+        Returns the extracted codings and text shaped like the entries of sample_data.json.
+        """
+        return {"coding": [coding.as_dict() for coding in self.codings], "text": self.text}
 
     @property
     def code_error_issues(self):
@@ -36,10 +135,12 @@ class Resource:
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json",
         }
-        response = requests.get(
-            f"https://interop-validation.prod.projectronin.io/resources/{self.id}/issues",
+        url = f"{INTEROP_VALIDATION_BASE_URL}/resources/{self.id}/issues"
+        response = http_client.get(
+            url,
             headers=headers,
         )
+        response.raise_for_status()
         issues = response.json()
 
         for issue in issues:
@@ -53,7 +154,7 @@ class Resource:
                 )
             )
 
-@dataclass
+@dataclass(slots=True)
 class Issue:
     id: str
     severity: str
@@ -62,9 +163,12 @@ class Issue:
     status: str
 
 
-def get_resources_from_service():
+def get_resources_from_service(status=None, resource_type=None, organization_id=None):
     """
     This will be the first part of the infx error ingestion. Getting the errors.
+    @param status: only return resources with this status (or any of these statuses)
+    @param resource_type: only return resources of this type, e.g. "Condition"
+    @param organization_id: only return resources of this organization
     @return:
     """
     # get token
@@ -75,20 +179,102 @@ def get_resources_from_service():
         "Content-Type": "application/json",
     }
     # Get resources using the token
-    data_validation_resources = requests.get(
-        "https://interop-validation.prod.projectronin.io/resources",
-        # this end point has parameters to filter by status, organization_id and/or resource_type
+    url = f"{INTEROP_VALIDATION_BASE_URL}/resources"
+    response = http_client.get(
+        url,
+        params=resource_filters(status, resource_type, organization_id),
         headers=headers,
-    ).json()
-    return [
-        Resource(
-            id=item.get('id'),
-            resource_type=item.get('resource_type'),
-            resource=item.get('resource'),
-            status=item.get('status'),
-            severity=item.get('severity')
-        ) for item in data_validation_resources
-    ]
+    )
+    response.raise_for_status()
+    data_validation_resources = response.json()
+    return [resource_from_item(item) for item in data_validation_resources]
+
+
+def resource_filters(status=None, resource_type=None, organization_id=None):
+    """
+    Builds the query parameters the /resources end point filters on, so that filtering happens server-side.
+    """
+    params = {}
+    if status:
+        params["status"] = status
+    if resource_type:
+        params["resource_type"] = resource_type
+    if organization_id:
+        params["organization_id"] = organization_id
+    return params
+
+
+def resource_from_item(item):
+    return Resource(
+        id=item.get('id'),
+        resource_type=item.get('resource_type'),
+        resource=item.get('resource'),
+        status=item.get('status'),
+        severity=item.get('severity')
+    )
+
+
+def iter_resources_from_service(page_size=RESOURCES_PAGE_SIZE, status=None, resource_type=None, organization_id=None):
+    """
+    Streaming version of get_resources_from_service: pages through the resources with the
+    service's limit/after cursor and yields them one at a time, so only one page is held in memory.
+    @param page_size: the number of resources requested per page
+    @param status: only return resources with this status (or any of these statuses)
+    @param resource_type: only return resources of this type, e.g. "Condition"
+    @param organization_id: only return resources of this organization
+    @return: a generator of Resource
+    """
+    url = f"{INTEROP_VALIDATION_BASE_URL}/resources"
+    after = None
+    while True:
+        headers = {
+            "Authorization": f"Bearer {get_access_token()}",
+            "Content-Type": "application/json",
+        }
+        params = {"order": "ASC", "limit": page_size, **resource_filters(status, resource_type, organization_id)}
+        if after:
+            params["after"] = after
+        response = http_client.get(url, params=params, headers=headers)
+        # an error body is not a page: stop rather than yield from it or end the stream early
+        response.raise_for_status()
+        page = response.json()
+        for item in page:
+            yield resource_from_item(item)
+        if len(page) < page_size:
+            return
+        after = page[-1].get('id')
+
+
+def load_issues_bulk(resources, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Loads the issues of many resources concurrently; the service has no batched issues end point.
+    @param resources: an iterable of Resource, consumed lazily
+    @param max_workers: the maximum number of issue requests in flight
+    @return: a generator of the resources, in input order, with their issues loaded
+    """
+    def load(resource):
+        resource.load_issues()
+        return resource
+
+    return map_concurrently(load, resources, max_workers)
+
+
+def iter_code_error_resources(status=UNRESOLVED_STATUSES, organization_id=None, page_size=RESOURCES_PAGE_SIZE,
+                              max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Streams the Condition resources that failed validation because of their coding. Status,
+    resource type and organization are filtered server-side, the issues are loaded concurrently.
+    @param status: only return resources with this status (or any of these statuses)
+    @param organization_id: only return resources of this organization
+    @param page_size: the number of resources requested per page
+    @param max_workers: the maximum number of issue requests in flight
+    @return: a generator of Resource with at least one code error issue, their codings extracted
+    """
+    resources = iter_resources_from_service(page_size, status, "Condition", organization_id)
+    for resource in load_issues_bulk(resources, max_workers):
+        if resource.code_error_issues:
+            resource.extract_codings()
+            yield resource
 
 
 if __name__ == "__main__":
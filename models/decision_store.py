@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import time
+
+from models.records import MatchResult
+
+
+class DecisionStore:
+    """
+    Persistent record of the match decided for each (code, display text) pair, so a re-run only
+    evaluates the pairs it has not seen before.
+
+    Decisions are stored per branch and release. Opening the store for a release other than the one
+    its decisions were made against drops that branch's decisions, since a new release can change
+    the terms, status and substitutes of any concept.
+    """
+
+    def __init__(self, db_path, branch, release):
+        """
+        Args:
+            db_path (str): Path of the SQLite database file.
+            branch (str): The branch of the concepts repository the decisions are made against.
+            release (str): Identifies the content of the branch and the matcher configuration; see
+                models.snowstorm.get_release and automapping.decision_release.
+        """
+        self.branch = branch
+        self.release = release
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS decisions (
+                branch TEXT NOT NULL,
+                release TEXT NOT NULL,
+                code TEXT NOT NULL,
+                display TEXT NOT NULL,
+                matched_code TEXT,
+                matched_reason TEXT,
+                fsn_for_matched_code TEXT,
+                similarity REAL,
+                decided_at REAL NOT NULL,
+                PRIMARY KEY (branch, code, display, release)
+            )
+            """
+        )
+        self.invalidated = self._db.execute(
+            "DELETE FROM decisions WHERE branch = ? AND release != ?", (branch, release)
+        ).rowcount
+        self._db.commit()
+
+    def get(self, code, display):
+        """
+        Returns the MatchResult decided for the pair in an earlier run, or None if it was not decided yet.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT matched_code, matched_reason, fsn_for_matched_code, similarity FROM decisions "
+                "WHERE branch = ? AND release = ? AND code = ? AND display = ?",
+                (self.branch, self.release, str(code), display),
+            ).fetchone()
+            return MatchResult(*row) if row is not None else None
+
+    def record(self, code, display, result):
+        """
+        Stores the decision for a pair. It is written to disk on the next commit.
+
+        Args:
+            code (str): The code supplied by the source system.
+            display (str): The display text supplied by the source system.
+            result (MatchResult): The decision; a result without matched code records that there is no match.
+        """
+        self.record_many([(code, display, result)])
+
+    def record_many(self, decisions):
+        """
+        Stores many (code, display text, MatchResult) decisions at once.
+        """
+        decided_at = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO decisions (branch, release, code, display, matched_code, matched_reason, "
+                "fsn_for_matched_code, similarity, decided_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (self.branch, self.release, str(code), display) + tuple(result) + (decided_at,)
+                    for code, display, result in decisions
+                ],
+            )
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def forget(self, code=None, display=None):
+        """
+        Drops decisions so they are evaluated again: all of the branch, those for one code, or the one
+        for a (code, display text) pair.
+        """
+        sql = "DELETE FROM decisions WHERE branch = ?"
+        parameters = [self.branch]
+        if code is not None:
+            sql += " AND code = ?"
+            parameters.append(str(code))
+        if display is not None:
+            sql += " AND display = ?"
+            parameters.append(display)
+        with self._lock:
+            self._db.execute(sql, parameters)
+            self._db.commit()
+
+    def close(self):
+        self.commit()
+        self._db.close()
@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+FUZZY = "FUZZY"
+DEFAULT_THRESHOLD = 0.85
+NGRAM_RANGE = (2, 4)
+# Refit instead of appending when new concepts would add more than this fraction of the fitted rows,
+# since n-grams outside the fitted vocabulary are ignored
+REFIT_FRACTION = 0.1
+
+
+class FuzzyMatcher:
+    """
+    Fuzzy match tier: cosine similarity between char n-gram TF-IDF vectors of the input display text and
+    of the concept's descriptions.
+
+    The normalized descriptions of the term index are vectorized once into a sparse matrix. A batch of
+    (code, display) pairs is scored with a single sparse element-wise multiply of the input vectors
+    against the rows of their concepts' descriptions, instead of comparing strings pair by pair.
+    """
+
+    def __init__(self, term_index, threshold=DEFAULT_THRESHOLD):
+        """
+        Args:
+            term_index (TermIndex): The index whose normalized descriptions make up the corpus.
+            threshold (float): Minimum similarity, between 0 and 1, for a FUZZY match (default: DEFAULT_THRESHOLD).
+        """
+        self.term_index = term_index
+        self.threshold = threshold
+        self._vectorizer = None
+        self._matrix = None
+        self._concept_rows = {}
+        self._fitted_rows = 0
+        self._lock = threading.Lock()
+
+    def fit(self):
+        """
+        Fits the TF-IDF weights on every normalized description of the term index and vectorizes them.
+        Call it once the index holds the run's concept set; concepts indexed afterwards are vectorized
+        with the same weights as they are first scored.
+        """
+        with self._lock:
+            terms = []
+            concept_rows = {}
+            for term, concept_ids in self.term_index.normalized_terms():
+                for concept_id in concept_ids:
+                    concept_rows.setdefault(concept_id, []).append(len(terms))
+                terms.append(term)
+            if not terms:
+                return
+            vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=NGRAM_RANGE, lowercase=True)
+            self._matrix = vectorizer.fit_transform(terms).tocsr()
+            self._vectorizer = vectorizer
+            self._concept_rows = concept_rows
+            self._fitted_rows = len(terms)
+
+    def _add_concepts(self, concept_ids):
+        if self._vectorizer is None:
+            self.fit()
+            if self._vectorizer is None:
+                return
+        new_concept_ids = [
+            concept_id for concept_id in dict.fromkeys(str(concept_id) for concept_id in concept_ids)
+            if concept_id not in self._concept_rows and concept_id in self.term_index
+        ]
+        new_term_count = sum(len(self.term_index.concept_terms(concept_id)) for concept_id in new_concept_ids)
+        if new_term_count > self._fitted_rows * REFIT_FRACTION:
+            self.fit()
+            return
+        with self._lock:
+            new_concept_ids = [concept_id for concept_id in new_concept_ids if concept_id not in self._concept_rows]
+            terms = []
+            new_concept_rows = {}
+            for concept_id in new_concept_ids:
+                concept_terms = self.term_index.concept_terms(concept_id)
+                first_row = self._matrix.shape[0] + len(terms)
+                new_concept_rows[concept_id] = list(range(first_row, first_row + len(concept_terms)))
+                terms.extend(concept_terms)
+            if terms:
+                self._matrix = sparse.vstack([self._matrix, self._vectorizer.transform(terms)], format="csr")
+            # published after the matrix grows, so scoring threads never see rows the matrix lacks
+            self._concept_rows.update(new_concept_rows)
+
+    def score(self, pairs):
+        """
+        Scores a batch of (concept ID, display text) pairs.
+
+        Args:
+            pairs (list): (concept ID, display text) tuples.
+
+        Returns:
+            list: For each pair, the best cosine similarity between the normalized display text and the
+            concept's descriptions, or None if the concept is not in the term index.
+        """
+        scores = [None] * len(pairs)
+        if not pairs:
+            return scores
+        self._add_concepts(concept_id for concept_id, _ in pairs)
+        if self._vectorizer is None:
+            return scores
+
+        input_rows, description_rows = [], []
+        for pair_number, (concept_id, _) in enumerate(pairs):
+            rows = self._concept_rows.get(str(concept_id), ())
+            input_rows.extend([pair_number] * len(rows))
+            description_rows.extend(rows)
+        if not description_rows:
+            return scores
+        matrix = self._matrix
+
+        normalize, strip_ignorable = self.term_index.normalize, self.term_index.strip_ignorable
+        input_matrix = self._vectorizer.transform(
+            [strip_ignorable(normalize(display)) for _, display in pairs]
+        ).tocsr()
+        # both matrices are L2-normalized by the vectorizer, so the row-wise dot product is the cosine
+        similarities = np.asarray(
+            input_matrix[input_rows].multiply(matrix[description_rows]).sum(axis=1)
+        ).ravel()
+        best = np.full(len(pairs), -1.0)
+        np.maximum.at(best, np.asarray(input_rows), similarities)
+        for pair_number, similarity in enumerate(best):
+            if similarity >= 0:
+                scores[pair_number] = float(similarity)
+        return scores
+
+    def match(self, pairs):
+        """
+        Applies the FUZZY tier to a batch of (concept ID, display text) pairs.
+
+        Returns:
+            list: For each pair, (FUZZY, score) if the score reaches the threshold, else (None, score).
+        """
+        return [
+            (FUZZY if score is not None and score >= self.threshold else None, score)
+            for score in self.score(pairs)
+        ]
@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from models.concurrency import DEFAULT_MAX_WORKERS, throttle
+from models.metrics import METRICS
+
+DEFAULT_TIMEOUT = (5, 60)  # (connect, read) seconds
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Methods that can be sent twice without a second effect; other methods (POST) are only retried when the
+# request cannot have reached the server: connection failures and 429 responses
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+_pool_size = DEFAULT_MAX_WORKERS
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def set_pool_size(pool_size):
+    """
+    Sets how many keep-alive connections are kept per upstream host. Should be at least the number
+    of workers making requests concurrently. Existing sessions are closed and recreated on next use.
+    """
+    global _pool_size
+    with _sessions_lock:
+        _pool_size = max(pool_size, 1)
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_session(url):
+    """
+    Returns the pooled session shared by all requests to the base URL (scheme + host) of `url`.
+    """
+    parsed = urlparse(url)
+    base_url = f"{parsed.scheme}://{parsed.netloc}"
+    with _sessions_lock:
+        session = _sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+            session.mount(base_url, adapter)
+            _sessions[base_url] = session
+        return session
+
+
+def _backoff(attempt, response=None):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), BACKOFF_MAX_SECONDS)
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _not_sent(error):
+    """
+    Whether a request failed before it was sent: the connection could not be established.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Sends a request over the pooled session for the URL's host, after waiting for the host's rate limit.
+    Idempotent requests are retried with exponential backoff and jitter on a 429 or 5xx status, connection
+    errors and timeouts. Other requests (POST) may already have taken effect after a read timeout or a 5xx
+    response, so they are only retried when the connection could not be established or on a 429.
+
+    Args:
+        method (str): The HTTP method.
+        url (str): The full URL.
+        timeout: Timeout passed to requests, in seconds or as (connect, read) (default: DEFAULT_TIMEOUT).
+        max_retries (int): How many times to retry before giving up (default: MAX_RETRIES).
+        **kwargs: Passed on to requests (params, json, data, headers, ...).
+
+    Returns:
+        requests.Response: The last response received; callers check its status code as before.
+    """
+    session = get_session(url)
+    host = urlparse(url).hostname
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else {429}
+    for attempt in range(max_retries + 1):
+        throttle(url)
+        try:
+            with METRICS.timed(f"upstream {host}"):
+                response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            METRICS.count("upstream_requests", host=host, status=type(error).__name__)
+            if attempt == max_retries or not (idempotent or _not_sent(error)):
+                raise
+            print(f"Retrying {method} {url} after error: {error}")
+            time.sleep(_backoff(attempt))
+            continue
+        METRICS.count("upstream_requests", host=host, status=response.status_code)
+        if response.status_code not in retry_status_codes or attempt == max_retries:
+            return response
+        print(f"Retrying {method} {url} after status {response.status_code}")
+        time.sleep(_backoff(attempt, response))
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,111 @@
+import json
+from itertools import islice
+
+READ_CHUNK_SIZE = 1024 * 1024
+DEFAULT_BATCH_SIZE = 1000
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+_number_characters = "0123456789+-.eE"
+
+
+def read_conditions(path):
+    """
+    Lazily reads conditions from a file, holding at most one read chunk and one condition in memory.
+
+    Files ending in .ndjson or .jsonl are read as one JSON object per line. Anything else must be a JSON
+    array of objects (like sample_data.json), which is parsed incrementally.
+
+    Args:
+        path (str): Path of the input file.
+
+    Yields:
+        dict: One condition at a time.
+    """
+    if path.endswith((".ndjson", ".jsonl")):
+        with open(path) as input_file:
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path) as input_file:
+            yield from iter_json_array(input_file)
+
+
+def iter_json_array(input_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Incrementally parses a JSON array from a text file object, yielding its elements one at a time.
+    """
+    buffer = ""
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in _whitespace:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if buffer[position:position + 1] != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+    expect_value = True
+    after_comma = False
+    while True:
+        skip_whitespace()
+        if position >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[position] == "]" and not after_comma:
+            return
+        if not expect_value:
+            if buffer[position] != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[position]!r}")
+            position += 1
+            expect_value = after_comma = True
+            continue
+        if buffer[position] in ",]":
+            raise ValueError(f"Expected a value in JSON array, got {buffer[position]!r}")
+        try:
+            value, end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # the element may be cut off at the end of the buffer
+            if eof:
+                raise
+            fill()
+            continue
+        rest = buffer[end:]
+        if not eof and (not rest.lstrip(_whitespace) or not rest.lstrip(_number_characters)):
+            # only a delimiter ends an element: a number cut off at the end of the buffer, such as
+            # "-25000000000.", decodes as its digits so far and continues in the next chunk
+            fill()
+            continue
+        delimiter = rest.lstrip(_whitespace)[:1]
+        if delimiter not in (",", "]"):
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {delimiter or 'end of file'!r}")
+        position = end
+        expect_value = after_comma = False
+        yield value
+
+
+def batched(iterable, size=DEFAULT_BATCH_SIZE):
+    """
+    Groups an iterable into lists of up to `size` items, reading no further ahead than one batch.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,96 @@
+import csv
+import json
+import threading
+
+DEFAULT_CANDIDATE_LIMIT = 3
+
+
+class ManualMappingQueue:
+    """
+    Work queue for the conditions that could not be automapped, de-duplicated for reviewers.
+
+    Conditions are grouped by their set of codes and their normalized text (case and whitespace are
+    folded as well), and every occurrence is counted. The best candidate concepts of an item are looked
+    up once, when it is first seen. The export lists the items with the most occurrences first, so a
+    reviewer's time goes where it resolves the most rows.
+    """
+
+    def __init__(self, normalize=None, find_candidates=None, candidate_limit=DEFAULT_CANDIDATE_LIMIT):
+        """
+        Args:
+            normalize (callable): Normalizes display text before grouping, e.g. automapping.normalize_synonyms
+                (default: None, only case and whitespace are folded).
+            find_candidates (callable): Returns (concept ID, score, reason or term) tuples for a text, best
+                first, e.g. automapping.find_candidates (default: None, items have no candidates).
+            candidate_limit (int): Number of candidates kept per item (default: DEFAULT_CANDIDATE_LIMIT).
+        """
+        self.normalize = normalize
+        self.find_candidates = find_candidates
+        self.candidate_limit = candidate_limit
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def key(self, codes, text):
+        normalized_text = self.normalize(text) if self.normalize else text
+        return tuple(sorted(set(codes))), " ".join(normalized_text.casefold().split())
+
+    def add(self, codes, text, candidates=None):
+        """
+        Counts one condition that needs manual mapping. Safe to call from several threads.
+
+        Args:
+            codes (iterable): The codes supplied with the condition.
+            text (str): The display text supplied with the condition.
+            candidates (list): (concept ID, score, reason or term) tuples already known for the condition;
+                looked up with find_candidates when not given (default: None).
+        """
+        key = self.key(codes, text)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                item["count"] += 1
+                return
+        if candidates is None and self.find_candidates is not None:
+            candidates = self.find_candidates(text)
+        candidates = [
+            {"code": concept_id, "score": score, "match": reason}
+            for concept_id, score, reason in (candidates or [])[:self.candidate_limit]
+        ]
+        with self._lock:
+            item = self._items.setdefault(
+                key,
+                {"codes": list(key[0]), "text": text, "normalized_text": key[1], "count": 0, "candidates": candidates},
+            )
+            item["count"] += 1
+
+    def export(self, path=None, limit=None):
+        """
+        Returns the queued items with the most occurrences first, optionally writing them to a file.
+
+        Args:
+            path (str): A .json file gets the items as a JSON array, any other path a CSV file with the
+                codes and candidates JSON-encoded (default: None, nothing is written).
+            limit (int): Only export this many items (default: None, all of them).
+
+        Returns:
+            list: The items: "codes", "text", "normalized_text", "count" and "candidates".
+        """
+        with self._lock:
+            items = sorted(self._items.values(), key=lambda item: -item["count"])[:limit]
+        if path and path.endswith(".json"):
+            with open(path, "w") as output_file:
+                json.dump(items, output_file, indent=2)
+        elif path:
+            with open(path, "w", newline="") as output_file:
+                writer = csv.DictWriter(output_file, ["count", "codes", "text", "normalized_text", "candidates"])
+                writer.writeheader()
+                for item in items:
+                    writer.writerow({
+                        **item,
+                        "codes": json.dumps(item["codes"]),
+                        "candidates": json.dumps(item["candidates"]),
+                    })
+        return items
@@ -0,0 +1,209 @@
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "automapping"
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    In-process instrumentation of the matching pipeline: time spent per stage, counters (upstream
+    requests, match reasons, ...) and gauges read at export time (cache hit ratios).
+
+    Recording is a lock plus a dict update, cheap enough to leave on; set `enabled` to False to turn
+    it off entirely. Exporters registered with add_exporter are called by export().
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.started_at = time.time()
+        self._timings = {}
+        self._counters = {}
+        self._gauges = {}
+        self._exporters = []
+        self._lock = threading.Lock()
+
+    def record_time(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            calls, total, longest = self._timings.get(stage, (0, 0.0, 0.0))
+            self._timings[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Records the time spent in the `with` block under the given stage.
+        """
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(stage, time.perf_counter() - started)
+
+    def count(self, name, amount=1, **labels):
+        """
+        Adds `amount` to the counter `name` with the given labels, e.g. count("match_reasons", reason="EXACT").
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauge(self, name, read, **labels):
+        """
+        Registers a zero-argument function whose value is reported as the gauge `name` at export time.
+        """
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = read
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def summary(self):
+        """
+        Returns every metric as a JSON-serializable dict.
+        """
+        with self._lock:
+            timings = dict(self._timings)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        summary = {
+            "started_at": self.started_at,
+            "elapsed_seconds": time.time() - self.started_at,
+            "stages": {
+                stage: {"calls": calls, "seconds": total, "max_seconds": longest,
+                        "mean_seconds": total / calls if calls else None}
+                for stage, (calls, total, longest) in sorted(timings.items())
+            },
+            "counters": {},
+            "gauges": {},
+        }
+        for (name, labels), value in sorted(counters.items()):
+            summary["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for (name, labels), read in sorted(gauges.items(), key=lambda item: item[0]):
+            summary["gauges"].setdefault(name, []).append({"labels": dict(labels), "value": read()})
+        return summary
+
+    def prometheus_text(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            timings = dict(self._timings)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        # every family's TYPE line is followed by all of its samples, as the format requires
+        families = {}
+        for stage, (calls, total, longest) in sorted(timings.items()):
+            labels = _label_text([("stage", stage)])
+            families.setdefault((f"{PREFIX}_stage_seconds_total", "counter"), []).append(f"{labels} {total}")
+            families.setdefault((f"{PREFIX}_stage_calls_total", "counter"), []).append(f"{labels} {calls}")
+            families.setdefault((f"{PREFIX}_stage_seconds_max", "gauge"), []).append(f"{labels} {longest}")
+        for (name, labels), value in sorted(counters.items()):
+            families.setdefault((f"{PREFIX}_{name}_total", "counter"), []).append(f"{_label_text(labels)} {value}")
+        for (name, labels), read in sorted(gauges.items(), key=lambda item: item[0]):
+            value = read()
+            families.setdefault((f"{PREFIX}_{name}", "gauge"), []).append(
+                f"{_label_text(labels)} {'NaN' if value is None else value}"
+            )
+        lines = []
+        for (family, metric_type), samples in families.items():
+            lines.append(f"# TYPE {family} {metric_type}")
+            lines.extend(f"{family}{sample}" for sample in samples)
+        return "\n".join(lines) + "\n"
+
+    def add_exporter(self, exporter):
+        """
+        Registers an exporter: a function called with this Metrics object by export().
+        """
+        self._exporters.append(exporter)
+
+    def export(self):
+        for exporter in self._exporters:
+            exporter(self)
+
+
+class JsonSummaryExporter:
+    """
+    Exporter writing the metrics summary to a JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, metrics):
+        with open(self.path, "w") as output_file:
+            json.dump(metrics.summary(), output_file, indent=2)
+
+
+class PrometheusExporter:
+    """
+    Serves the metrics in the Prometheus text format on http://<host>:<port>/metrics from a background
+    thread, so a batch run can be scraped while it works. The metrics are read live, export() is a no-op.
+    """
+
+    def __init__(self, metrics, port, host="0.0.0.0"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def __call__(self, metrics):
+        pass
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    Profiles the `with` block with cProfile and dumps the stats to `path` (readable with pstats or
+    snakeviz). Without a path nothing is profiled, so it can stay in place at no cost.
+    """
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+# Shared by every instrumented module
+METRICS = Metrics()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_MAX_WAIT_SECONDS = 0.01
+
+
+class MicroBatcher:
+    """
+    Coalesces items submitted by concurrent callers into batches for one function call.
+
+    A background thread takes the queued items as soon as any are waiting, lingers up to
+    `max_wait_seconds` for more callers to join (or until `max_batch_size` items are queued), and calls
+    `process_batch` once for all of them. Each caller blocks until the results of its own items are in.
+    If the batch call raises, its items are processed one by one, so an item that fails only fails itself
+    and not the unrelated requests it was batched with.
+    """
+
+    def __init__(self, process_batch, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS):
+        """
+        Args:
+            process_batch (callable): Called with a list of items; returns one result per item, in order.
+                An exception in place of a result fails that item alone.
+            max_batch_size (int): Most items processed in one call (default: DEFAULT_MAX_BATCH_SIZE).
+            max_wait_seconds (float): How long a batch waits for more items (default: DEFAULT_MAX_WAIT_SECONDS).
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = deque()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items, return_exceptions=False):
+        """
+        Queues the items and waits for their results.
+
+        Args:
+            items (list): The items of one caller.
+            return_exceptions (bool): Return the exception an item failed with in place of its result,
+                instead of raising it (default: False).
+
+        Returns:
+            list: The result of every item, in order.
+        """
+        futures = [Future() for _ in items]
+        with self._condition:
+            self._queue.extend(zip(items, futures))
+            self._condition.notify()
+        if return_exceptions:
+            return [future.exception() or future.result() for future in futures]
+        return [future.result() for future in futures]
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+    def _run(self):
+        while True:
+            self._process(self._next_batch())
+
+    def _process(self, batch):
+        try:
+            results = self.process_batch([item for item, _ in batch])
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][1].set_exception(error)
+                return
+            for entry in batch:
+                self._process([entry])
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,127 @@
+import csv
+import json
+import re
+from functools import lru_cache
+
+from models.metrics import METRICS
+
+DEFAULT_CACHE_SIZE = 200000
+
+_punctuation_pattern = r"[^\w\s]"
+
+
+def _trie_pattern(phrases):
+    """
+    Builds a regex alternation of the phrases shaped like a trie, so that matching cost depends on the
+    length of the text rather than on the number of phrases. Whitespace inside a phrase matches any run
+    of whitespace.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in " ".join(phrase.split()):
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    branches = [
+        (r"\s+" if char == " " else re.escape(char)) + _node_pattern(child)
+        for char, child in sorted(node.items()) if char != ""
+    ]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    return "(?:" + "|".join(branches) + ")" + ("?" if "" in node else "")
+
+
+def compile_ignorable(ignorable_strings, fold_case=False):
+    """
+    Compiles ignorable strings into one pattern; returns None when there are none.
+    """
+    if not ignorable_strings:
+        return None
+    flags = re.IGNORECASE if fold_case else 0
+    return re.compile(_trie_pattern(ignorable_strings), flags)
+
+
+def load_synonym_table(path):
+    """
+    Loads a synonym table from a file: either a JSON object of term to replacement, or a CSV file whose
+    rows are term, replacement (a first row of "term", "replacement" is treated as a header).
+
+    Args:
+        path (str): Path of the .json or .csv file.
+
+    Returns:
+        dict: Term (lower case) to replacement.
+    """
+    if path.endswith(".json"):
+        with open(path) as input_file:
+            table = json.load(input_file)
+    else:
+        with open(path, newline="") as input_file:
+            rows = [row for row in csv.reader(input_file) if len(row) >= 2]
+        if rows and [value.strip().lower() for value in rows[0][:2]] == ["term", "replacement"]:
+            rows = rows[1:]
+        table = {row[0]: row[1] for row in rows}
+    return {" ".join(term.lower().split()): replacement.strip() for term, replacement in table.items()}
+
+
+class Normalizer:
+    """
+    Text normalization compiled into a single regex pass: synonym words and multi-word phrases are
+    replaced (matched case-insensitively on word boundaries, so trailing punctuation does not prevent a
+    match), runs of whitespace are collapsed, and optionally punctuation is dropped and case is folded.
+    Results are memoized, since the same descriptions and inputs are normalized over and over.
+    """
+
+    def __init__(self, synonyms, fold_case=False, fold_punctuation=False, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Args:
+            synonyms (dict): Word or phrase to its replacement.
+            fold_case (bool): Lower-case the normalized text (default: False).
+            fold_punctuation (bool): Remove punctuation from the normalized text (default: False).
+            cache_size (int): Number of normalized strings memoized (default: DEFAULT_CACHE_SIZE).
+        """
+        self.synonyms = {" ".join(term.lower().split()): replacement for term, replacement in synonyms.items()}
+        self.fold_case = fold_case
+        self.fold_punctuation = fold_punctuation
+
+        alternatives = []
+        if self.synonyms:
+            alternatives.append(rf"(?P<synonym>\b{_trie_pattern(self.synonyms)}\b)")
+        alternatives.append(r"(?P<space>\s+)")
+        if fold_punctuation:
+            alternatives.append(rf"(?P<punctuation>{_punctuation_pattern})")
+        self._pattern = re.compile("|".join(alternatives), re.IGNORECASE)
+
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _replace(self, match):
+        if match.lastgroup == "synonym":
+            return self.synonyms[" ".join(match.group().lower().split())]
+        if match.lastgroup == "space":
+            return " "
+        return ""
+
+    def hit_ratio(self):
+        """
+        Returns the share of normalize calls answered from its cache, or None before the first call.
+        """
+        info = self.normalize.cache_info()
+        calls = info.hits + info.misses
+        return info.hits / calls if calls else None
+
+    def _normalize(self, text):
+        with METRICS.timed("normalize"):
+            return self._normalize_uncached(text)
+
+    def _normalize_uncached(self, text):
+        normalized = self._pattern.sub(self._replace, text).strip()
+        if self.fold_punctuation:
+            # removing punctuation can leave double spaces, e.g. "a - b"
+            normalized = " ".join(normalized.split())
+        return normalized.lower() if self.fold_case else normalized
@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+
+@dataclass(frozen=True, slots=True)
+class Coding:
+    system: str
+    code: str
+    display: Optional[str] = None
+
+    def as_dict(self):
+        return {"system": self.system, "code": self.code, "display": self.display}
+
+
+class MatchResult(NamedTuple):
+    """
+    Result of matching one (code, display text) pair. A plain tuple underneath, so existing code that
+    unpacks match results keeps working.
+    """
+    matched_code: Optional[str]
+    matched_reason: Optional[str]
+    fsn_for_matched_code: Optional[str]
+    similarity: Optional[float]
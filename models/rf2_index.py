@@ -0,0 +1,272 @@
+import csv
+import glob
+import os
+import sqlite3
+import sys
+import threading
+
+US_ENGLISH = "900000000000509007"
+FSN_TYPE_ID = "900000000000003001"
+SYNONYM_TYPE_ID = "900000000000013009"
+ACCEPTABILITY = {
+    "900000000000548007": "PREFERRED",
+    "900000000000549004": "ACCEPTABLE",
+}
+DESCRIPTION_TYPES = {
+    FSN_TYPE_ID: "FSN",
+    SYNONYM_TYPE_ID: "SYNONYM",
+}
+# Historical association refsets used to find the active substitutes of inactive concepts
+SAME_AS = "900000000000527005"
+REPLACED_BY = "900000000000526001"
+POSSIBLY_EQUIVALENT_TO = "900000000000523009"
+HISTORICAL_ASSOCIATIONS = {
+    SAME_AS: "SAME AS",
+    REPLACED_BY: "REPLACED BY",
+    POSSIBLY_EQUIVALENT_TO: "POSSIBLY EQUIVALENT TO",
+}
+INSERT_BATCH_SIZE = 50000
+
+
+def _find_file(snapshot_dir, pattern, required=True):
+    matches = sorted(glob.glob(os.path.join(snapshot_dir, "**", pattern), recursive=True))
+    if not matches:
+        if not required:
+            return None
+        raise FileNotFoundError(f"No file matching {pattern} in {snapshot_dir}")
+    return matches[0]
+
+
+def _read_rows(path):
+    with open(path, encoding="utf-8", newline="") as rf2_file:
+        yield from csv.DictReader(rf2_file, delimiter="\t", quoting=csv.QUOTE_NONE)
+
+
+def _insert_batched(db, sql, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.executemany(sql, batch)
+            batch = []
+    if batch:
+        db.executemany(sql, batch)
+
+
+def build_index(snapshot_dir, db_path):
+    """
+    Loads a SNOMED CT RF2 snapshot into an SQLite index keyed by conceptId, holding the PT, FSN and
+    active flag of every concept and its active US-English preferred and acceptable descriptions, plus
+    the active SAME AS, REPLACED BY and POSSIBLY EQUIVALENT TO historical associations when the snapshot
+    has an association refset file.
+
+    Args:
+        snapshot_dir (str): Directory containing the RF2 Snapshot files (searched recursively for the
+            concept, English description, English language refset and association refset files).
+        db_path (str): Path of the SQLite file to write; an existing index in it is replaced.
+    """
+    concept_file = _find_file(snapshot_dir, "sct2_Concept_Snapshot*.txt")
+    description_file = _find_file(snapshot_dir, "sct2_Description_Snapshot-en*.txt")
+    language_file = _find_file(snapshot_dir, "der2_cRefset_LanguageSnapshot-en*.txt")
+    association_file = _find_file(snapshot_dir, "der2_cRefset_AssociationSnapshot*.txt", required=False)
+
+    db = sqlite3.connect(db_path)
+    db.executescript(
+        """
+        DROP TABLE IF EXISTS concepts;
+        DROP TABLE IF EXISTS descriptions;
+        DROP TABLE IF EXISTS associations;
+        CREATE TABLE concepts (
+            concept_id TEXT PRIMARY KEY,
+            active INTEGER NOT NULL,
+            pt TEXT,
+            fsn TEXT
+        );
+        CREATE TABLE descriptions (
+            description_id TEXT PRIMARY KEY,
+            concept_id TEXT NOT NULL,
+            term TEXT NOT NULL,
+            type TEXT NOT NULL,
+            acceptability TEXT
+        );
+        CREATE TABLE associations (
+            source_id TEXT NOT NULL,
+            refset_id TEXT NOT NULL,
+            target_id TEXT NOT NULL
+        );
+        CREATE TEMP TABLE language (
+            description_id TEXT PRIMARY KEY,
+            acceptability TEXT NOT NULL
+        );
+        """
+    )
+    _insert_batched(
+        db,
+        "INSERT INTO concepts (concept_id, active) VALUES (?, ?)",
+        ((row["id"], int(row["active"])) for row in _read_rows(concept_file)),
+    )
+    _insert_batched(
+        db,
+        "INSERT INTO descriptions (description_id, concept_id, term, type) VALUES (?, ?, ?, ?)",
+        (
+            (row["id"], row["conceptId"], row["term"], DESCRIPTION_TYPES[row["typeId"]])
+            for row in _read_rows(description_file)
+            if row["active"] == "1" and row["typeId"] in DESCRIPTION_TYPES
+        ),
+    )
+    _insert_batched(
+        db,
+        "INSERT OR REPLACE INTO language (description_id, acceptability) VALUES (?, ?)",
+        (
+            (row["referencedComponentId"], ACCEPTABILITY[row["acceptabilityId"]])
+            for row in _read_rows(language_file)
+            if row["active"] == "1" and row["refsetId"] == US_ENGLISH and row["acceptabilityId"] in ACCEPTABILITY
+        ),
+    )
+    if association_file:
+        _insert_batched(
+            db,
+            "INSERT INTO associations (source_id, refset_id, target_id) VALUES (?, ?, ?)",
+            (
+                (row["referencedComponentId"], row["refsetId"], row["targetComponentId"])
+                for row in _read_rows(association_file)
+                if row["active"] == "1" and row["refsetId"] in HISTORICAL_ASSOCIATIONS
+            ),
+        )
+    db.executescript(
+        """
+        UPDATE descriptions SET acceptability = (
+            SELECT acceptability FROM language WHERE language.description_id = descriptions.description_id
+        );
+        DELETE FROM descriptions WHERE acceptability IS NULL;
+        CREATE INDEX descriptions_concept_id ON descriptions (concept_id);
+        UPDATE concepts SET
+            pt = (
+                SELECT term FROM descriptions
+                WHERE descriptions.concept_id = concepts.concept_id
+                AND type = 'SYNONYM' AND acceptability = 'PREFERRED'
+            ),
+            fsn = (
+                SELECT term FROM descriptions
+                WHERE descriptions.concept_id = concepts.concept_id
+                AND type = 'FSN' AND acceptability = 'PREFERRED'
+            );
+        DROP TABLE language;
+        """
+    )
+    db.commit()
+    db.close()
+
+
+class RF2Index:
+    """
+    Read-only access to an index built by build_index. Lookups return the same shapes as the
+    Snowstorm API, so it can be used in place of Snowstorm by models.snowstorm. Each thread gets a
+    connection of its own, since the lookups run on concurrent workers.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        return db
+
+    def get_concept(self, concept_id):
+        """
+        Returns the concept shaped like Snowstorm's /concepts/{conceptId}, or None if it is not in the index.
+        """
+        row = self._db.execute(
+            "SELECT concept_id, active, pt, fsn FROM concepts WHERE concept_id = ?", (str(concept_id),)
+        ).fetchone()
+        return self._to_concept(row) if row else None
+
+    def get_concepts(self, concept_ids):
+        """
+        Returns concept ID to concept for every given concept ID that is in the index.
+        """
+        concept_ids = [str(concept_id) for concept_id in concept_ids]
+        concepts = {}
+        # stay below SQLite's limit on the number of bound parameters
+        for start in range(0, len(concept_ids), 500):
+            chunk = concept_ids[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT concept_id, active, pt, fsn FROM concepts WHERE concept_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in rows:
+                concepts[row[0]] = self._to_concept(row)
+        return concepts
+
+    def concept_ids(self, active_only=True):
+        """
+        Returns the IDs of all (by default only the active) concepts in the index.
+        """
+        sql = "SELECT concept_id FROM concepts" + (" WHERE active = 1" if active_only else "")
+        return [row[0] for row in self._db.execute(sql)]
+
+    def associations(self):
+        """
+        Returns every historical association in the index as (source concept ID, refset ID, target
+        concept ID, whether the target is active) tuples. Indexes built without associations have none.
+        """
+        has_associations = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'associations'"
+        ).fetchone()
+        if not has_associations:
+            return []
+        return self._db.execute(
+            "SELECT source_id, refset_id, target_id, COALESCE(active, 0) FROM associations "
+            "LEFT JOIN concepts ON concepts.concept_id = associations.target_id"
+        ).fetchall()
+
+    def get_descriptions(self, concept_id):
+        """
+        Returns the US-English preferred and acceptable descriptions of a concept, shaped like
+        Snowstorm's "conceptDescriptions", or None if the concept is not in the index.
+        """
+        return self.get_descriptions_bulk([concept_id]).get(str(concept_id))
+
+    def get_descriptions_bulk(self, concept_ids):
+        """
+        Returns concept ID to list of descriptions for every given concept ID that is in the index.
+        """
+        concept_ids = [str(concept_id) for concept_id in concept_ids]
+        descriptions = {concept_id: [] for concept_id in self.get_concepts(concept_ids)}
+        for start in range(0, len(concept_ids), 500):
+            chunk = concept_ids[start:start + 500]
+            rows = self._db.execute(
+                "SELECT description_id, concept_id, term, type, acceptability FROM descriptions "
+                f"WHERE concept_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for description_id, concept_id, term, description_type, acceptability in rows:
+                descriptions[concept_id].append({
+                    "descriptionId": description_id,
+                    "conceptId": concept_id,
+                    "active": True,
+                    "term": term,
+                    "type": description_type,
+                    "lang": "en",
+                    "acceptabilityMap": {US_ENGLISH: acceptability},
+                })
+        return descriptions
+
+    @staticmethod
+    def _to_concept(row):
+        concept_id, active, pt, fsn = row
+        return {
+            "conceptId": concept_id,
+            "active": bool(active),
+            "pt": {"term": pt, "lang": "en"},
+            "fsn": {"term": fsn, "lang": "en"},
+        }
+
+
+if __name__ == "__main__":
+    # python -m models.rf2_index <RF2 snapshot directory> <index.sqlite>
+    build_index(sys.argv[1], sys.argv[2])
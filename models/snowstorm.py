@@ -1,3 +1,337 @@
+import os
+
+import requests
+
+from models import http_client
+from models.concept_cache import CONCEPT_CACHE, NOT_FOUND
+from models.metrics import METRICS
+from models.rf2_index import RF2Index
+
+SNOWSTORM_BASE_URL = "https://snowstorm.prod.projectronin.io"
+US_ENGLISH = "900000000000509007"
+SNOMED_SYSTEMS = ["http://snomed.info/sct", "urn:oid:2.16.840.1.113883.6.96"]
+# Number of concept IDs sent in one bulk request; keeps the query string well under URL length limits
+BULK_CHUNK_SIZE = 100
+DESCRIPTIONS_PAGE_SIZE = 1000
+# fields kept in the concept cache
+CONCEPT_FIELDS = ("conceptId", "active")
+DESCRIPTION_FIELDS = ("conceptId", "active", "term", "type", "acceptabilityMap")
+
+
+
+class SnowstormError(Exception):
+    """
+    Raised when Snowstorm could not answer a concept or description lookup: no response, or an error
+    status other than 404. Unlike a concept that does not exist, the lookup may succeed when retried, so
+    nothing should be decided from it.
+    """
+
+
+def _get(url, **kwargs):
+    try:
+        return http_client.get(url, **kwargs)
+    except requests.RequestException as error:
+        raise SnowstormError(f"No response from {url}: {error}") from error
+
+
+# When set, lookups are answered from a local RF2 snapshot index instead of the Snowstorm API
+_local_index = None
+
+
+def use_rf2_index(db_path):
+    """
+    Answers all concept and description lookups from a local RF2 index (see models.rf2_index) instead
+    of Snowstorm. The index holds a single release, so the branch argument of the lookups is ignored.
+
+    Args:
+        db_path (str): Path of the index built by models.rf2_index.build_index, or None to go back to Snowstorm.
+    """
+    global _local_index
+    _local_index = RF2Index(db_path) if db_path else None
+
+
+def use_cache_store(db_path, branch="MAIN"):
+    """
+    Keeps the shared concept cache in an SQLite file between runs, so repeat runs start warm. Entries
+    cached from an earlier release of the branch are dropped.
+
+    Args:
+        db_path (str): Path of the SQLite database file.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+    """
+    CONCEPT_CACHE.attach_store(db_path)
+    CONCEPT_CACHE.set_release(branch, get_release(branch))
+
+
+def get_release(branch="MAIN"):
+    """
+    Identifies the content of a branch, so results derived from it can be invalidated when it changes.
+
+    Args:
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        str: The head timestamp of the Snowstorm branch (or the path and modification time of the local
+        RF2 index), or None if it could not be fetched.
+    """
+    if _local_index is not None:
+        return f"rf2:{_local_index.db_path}:{os.path.getmtime(_local_index.db_path)}"
+    try:
+        response = _get(f"{SNOWSTORM_BASE_URL}/branches/{branch}")
+    except SnowstormError as error:
+        print(f"Error fetching branch {branch}: {error}")
+        return None
+    if response.status_code == 200:
+        return str(response.json()["headTimestamp"])
+    print(f"Error fetching branch {branch}: {response.status_code}")
+    return None
+
+
+def compact_concept(concept):
+    """
+    Keeps only the fields of a Snowstorm concept that the matching code reads, to shrink the cache.
+    """
+    compact = {key: concept[key] for key in CONCEPT_FIELDS if key in concept}
+    for key in ("pt", "fsn"):
+        if key in concept:
+            compact[key] = {"term": concept[key]["term"]}
+    return compact
+
+
+def compact_descriptions(descriptions):
+    """
+    Keeps only the fields of Snowstorm descriptions that the matching code reads, to shrink the cache.
+    """
+    return [
+        {key: description[key] for key in DESCRIPTION_FIELDS if key in description}
+        for description in descriptions
+    ]
+
+
+def get_concept(concept_id, branch="MAIN"):
+    """
+    Returns the Snowstorm concept (pt, fsn, active, ...) for the given concept ID, going through the
+    shared concept cache so each concept is only fetched once.
+
+    Args:
+        concept_id (str): The SNOMED concept ID to fetch.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        dict: The concept as returned by Snowstorm, or None if it does not exist.
+
+    Raises:
+        SnowstormError: If Snowstorm could not be reached or answered with an error.
+    """
+    if _local_index is not None:
+        return _local_index.get_concept(concept_id)
+
+    def fetch():
+        url = f"{SNOWSTORM_BASE_URL}/{branch}/concepts/{concept_id}"
+        with METRICS.timed("fetch_concepts"):
+            response = _get(url)
+        if response.status_code == 200:
+            return compact_concept(response.json())
+        if response.status_code != 404:
+            raise SnowstormError(f"Error fetching data for concept ID {concept_id}: {response.status_code}")
+        print(f"Error fetching data for concept ID {concept_id}: {response.status_code}")
+        return None
+
+    return CONCEPT_CACHE.get_or_fetch(branch, "concept", concept_id, fetch)
+
+
+def get_descriptions(concept_id, branch="MAIN"):
+    """
+    Returns all descriptions of the given concept ID, going through the shared concept cache.
+
+    Args:
+        concept_id (str): The SNOMED concept ID to fetch descriptions for.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        list: The "conceptDescriptions" returned by Snowstorm, or None if the concept does not exist.
+
+    Raises:
+        SnowstormError: If Snowstorm could not be reached or answered with an error.
+    """
+    if _local_index is not None:
+        return _local_index.get_descriptions(concept_id)
+
+    def fetch():
+        url = f"{SNOWSTORM_BASE_URL}/{branch}/concepts/{concept_id}/descriptions"
+        with METRICS.timed("fetch_descriptions"):
+            response = _get(
+                url,
+                headers={"Accept-Language": f"en-X-{US_ENGLISH}"},
+            )
+        if response.status_code == 200:
+            return compact_descriptions(response.json()["conceptDescriptions"])
+        if response.status_code != 404:
+            raise SnowstormError(f"Error fetching descriptions for concept ID {concept_id}: {response.status_code}")
+        print(f"Error fetching descriptions for concept ID {concept_id}: {response.status_code}")
+        return None
+
+    return CONCEPT_CACHE.get_or_fetch(branch, "descriptions", concept_id, fetch)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def collect_snomed_codes(conditions):
+    """
+    Collects the distinct SNOMED codes of a batch of conditions, in first-seen order.
+
+    Args:
+        conditions (iterable): Conditions shaped like sample_data.json ({"coding": [...], "text": ...})
+            or FHIR Condition resources from the validation service ({"code": {"coding": [...]}}).
+
+    Returns:
+        list: The de-duplicated SNOMED concept IDs.
+    """
+    codes = {}
+    for condition in conditions:
+        if "coding" in condition:
+            codeable_concepts = [condition]
+        else:
+            codeable_concepts = condition.get("code") or []
+            if isinstance(codeable_concepts, dict):
+                codeable_concepts = [codeable_concepts]
+        for codeable_concept in codeable_concepts:
+            for coding in codeable_concept.get("coding", []):
+                if coding.get("system") in SNOMED_SYSTEMS:
+                    codes[coding["code"]] = None
+    return list(codes)
+
+
+def get_concepts_bulk(concept_ids, branch="MAIN"):
+    """
+    Fetches the concepts (pt, fsn, active) for many concept IDs with chunked multi-ID requests to
+    `/concepts?conceptIds=`. Concepts already in the cache are not requested again and every fetched
+    concept is added to the cache, so later calls to get_concept are served locally. IDs the response
+    leaves out are cached as not found, so their later lookups make no request either.
+
+    Args:
+        concept_ids (iterable): The SNOMED concept IDs to fetch; duplicates are ignored.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        dict: Concept ID to concept, for every concept that could be found.
+    """
+    if _local_index is not None:
+        return _local_index.get_concepts(concept_ids)
+
+    concepts = {}
+    missing = []
+    for concept_id in dict.fromkeys(str(concept_id) for concept_id in concept_ids):
+        concept = CONCEPT_CACHE.get(branch, "concept", concept_id)
+        if concept is None:
+            missing.append(concept_id)
+        elif concept is not NOT_FOUND:
+            concepts[concept_id] = concept
+
+    for chunk in _chunks(missing, BULK_CHUNK_SIZE):
+        url = f"{SNOWSTORM_BASE_URL}/{branch}/concepts"
+        try:
+            with METRICS.timed("fetch_concepts"):
+                response = _get(
+                    url,
+                    params={"conceptIds": chunk, "limit": len(chunk)},
+                )
+        except SnowstormError as error:
+            # the concepts are looked up again one by one when they are matched
+            print(error)
+            continue
+        if response.status_code != 200:
+            print(f"Error fetching data for {len(chunk)} concept IDs: {response.status_code}")
+            continue
+        fetched = {concept["conceptId"]: compact_concept(concept) for concept in response.json()["items"]}
+        not_found = {concept_id: NOT_FOUND for concept_id in chunk if concept_id not in fetched}
+        CONCEPT_CACHE.put_many(branch, "concept", {**fetched, **not_found})
+        CONCEPT_CACHE.put_many(branch, "descriptions", not_found)
+        concepts.update(fetched)
+    return concepts
+
+
+def get_descriptions_bulk(concept_ids, branch="MAIN"):
+    """
+    Fetches the descriptions of many concept IDs with the bulk `/descriptions?conceptIds=` search,
+    paging through the results. Like get_concepts_bulk, it skips cached concepts and fills the cache.
+
+    Args:
+        concept_ids (iterable): The SNOMED concept IDs to fetch descriptions for; duplicates are ignored.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+
+    Returns:
+        dict: Concept ID to its list of descriptions, for every concept whose chunk could be fetched.
+    """
+    if _local_index is not None:
+        return _local_index.get_descriptions_bulk(concept_ids)
+
+    descriptions = {}
+    missing = []
+    for concept_id in dict.fromkeys(str(concept_id) for concept_id in concept_ids):
+        concept_descriptions = CONCEPT_CACHE.get(branch, "descriptions", concept_id)
+        if concept_descriptions is None:
+            missing.append(concept_id)
+        elif concept_descriptions is not NOT_FOUND:
+            descriptions[concept_id] = concept_descriptions
+
+    for chunk in _chunks(missing, BULK_CHUNK_SIZE):
+        chunk_descriptions = {concept_id: [] for concept_id in chunk}
+        url = f"{SNOWSTORM_BASE_URL}/{branch}/descriptions"
+        params = {"conceptIds": chunk, "limit": DESCRIPTIONS_PAGE_SIZE}
+        while True:
+            try:
+                with METRICS.timed("fetch_descriptions"):
+                    response = _get(
+                        url,
+                        params=params,
+                        headers={"Accept-Language": f"en-X-{US_ENGLISH}"},
+                    )
+            except SnowstormError as error:
+                print(error)
+                chunk_descriptions = None
+                break
+            if response.status_code != 200:
+                print(f"Error fetching descriptions for {len(chunk)} concept IDs: {response.status_code}")
+                chunk_descriptions = None
+                break
+            page = response.json()
+            for description in compact_descriptions(page["items"]):
+                chunk_descriptions.setdefault(description["conceptId"], []).append(description)
+            if not page.get("searchAfter") or len(page["items"]) < DESCRIPTIONS_PAGE_SIZE:
+                break
+            params["searchAfter"] = page["searchAfter"]
+
+        if chunk_descriptions is None:
+            continue
+        CONCEPT_CACHE.put_many(branch, "descriptions", chunk_descriptions)
+        descriptions.update(chunk_descriptions)
+    return descriptions
+
+
+def resolve_batch(conditions, branch="MAIN", include_descriptions=True):
+    """
+    Resolves every SNOMED code of a batch of conditions up front, so the per-condition lookups that
+    follow are served from the cache instead of making one or two HTTP calls each.
+
+    Args:
+        conditions (iterable): Conditions, see collect_snomed_codes.
+        branch (str): The branch of the concepts repository (default: "MAIN").
+        include_descriptions (bool): Also fetch the descriptions of every concept (default: True).
+
+    Returns:
+        dict: Concept ID to concept, for every concept that could be found.
+    """
+    concept_ids = collect_snomed_codes(conditions)
+    concepts = get_concepts_bulk(concept_ids, branch)
+    if include_descriptions:
+        get_descriptions_bulk(list(concepts), branch)
+    return concepts
+
+
 def get_snomed_terms(input_data):
     """
     Returns the SNOMED terms that match the input text by searching the SNOMED terminology.
@@ -7,41 +341,36 @@ def get_snomed_terms(input_data):
     coding_array = input_data["coding"]
     snomed_terms = []
     for coding in coding_array:
-        if coding["system"] in ["http://snomed.info/sct", "urn:oid:2.16.840.1.113883.6.96"]:
+        if coding["system"] in SNOMED_SYSTEMS:
             sctid = coding["code"]
-            pt_search = requests.get(
-                f"{SNOWSTORM_BASE_URL}/concepts?conceptIds={sctid}",
-            ).json()
-            if pt_search == {"error": "NOT_FOUND", "message": "Concept not found"}:
+            concept = get_concept(sctid)
+            if concept is None:
                 # TODO log error and sent the row to manual mapping
                 return None
             else:
-                first_item = pt_search["items"][0]
-                pt = first_item["pt"]["term"]
-                fsn = first_item["fsn"]["term"]
+                pt = concept["pt"]["term"]
+                fsn = concept["fsn"]["term"]
                 if input_data["text"] in [pt,fsn]:
                     snomed_terms.append(pt)
                     snomed_terms.append(fsn)
                 else:
-                    syn_search = requests.get(
-                        f"{SNOWSTORM_BASE_URL}/concepts/{sctid}/descriptions",
-                    ).json()
-                    concept_description = syn_search["conceptDescriptions"]
+                    concept_description = get_descriptions(sctid) or []
                     for item in concept_description:
                         syn_list = []
                         if item["type"] == "SYNONYM":
-                            if "900000000000509007" in item["acceptabilityMap"]:
-                                if item["acceptabilityMap"]["900000000000509007"] in ["ACCEPTABLE", "PREFERRED"]:
+                            if US_ENGLISH in item["acceptabilityMap"]:
+                                if item["acceptabilityMap"][US_ENGLISH] in ["ACCEPTABLE", "PREFERRED"]:
                                     syn_list.append(item["term"])
                                     if input_data["text"] in syn_list:
                                         snomed_terms.append(item["term"])
     return snomed_terms
 
-def process_system_snomed_for_term_match(input_data):
+def process_system_snomed_for_term_match(input_data, manual_queue=None):
     """
     Confirms concept is suitable for automapping by checking snowstorm for exact match of incoming {'coding':'text'}
     with SNOMED pt, fsn, preferred synonym, or acceptable synonym.
     @param input_data: the input data to be matched
+    @param manual_queue: a ManualMappingQueue (see models.manual_queue) that rows without a match are added to
     @return:
     """
     snomed_terms = get_snomed_terms(input_data)
@@ -53,5 +382,7 @@ def process_system_snomed_for_term_match(input_data):
         # if no create a new version in draft and add the concept
     else:
         print(f'No match found for: {input_data["text"]}')
-        # TODO log error and sent the row to manual mapping
+        if manual_queue is not None:
+            codes = [coding["code"] for coding in input_data["coding"] if coding["system"] in SNOMED_SYSTEMS]
+            manual_queue.add(codes, input_data["text"])
     return
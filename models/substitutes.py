@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+from models.rf2_index import POSSIBLY_EQUIVALENT_TO, REPLACED_BY, SAME_AS, RF2Index
+
+ACTIVE_SUBSTITUTE = "ACTIVE SUBSTITUTE"
+# Strongest association first; a concept is only substituted through its strongest association type
+ASSOCIATION_PRIORITY = [SAME_AS, REPLACED_BY, POSSIBLY_EQUIVALENT_TO]
+
+
+class SubstituteResolver:
+    """
+    Map from inactive concept to its active substitute, precomputed from the SNOMED historical
+    association refsets so a lookup is a dict access.
+
+    An inactive concept is substituted through its strongest association type (SAME AS, then REPLACED
+    BY, then POSSIBLY EQUIVALENT TO) when that type names a single target. A target that is itself
+    inactive is followed through its own associations until an active concept is reached. Concepts
+    whose strongest association is ambiguous (several targets), or whose chain loops or ends on an
+    inactive concept, have no substitute and are left for manual mapping.
+    """
+
+    def __init__(self, associations=()):
+        """
+        Args:
+            associations (iterable): (source concept ID, refset ID, target concept ID, whether the
+                target is active) tuples, as returned by RF2Index.associations.
+        """
+        targets = {}
+        active = {}
+        for source_id, refset_id, target_id, target_active in associations:
+            if refset_id not in ASSOCIATION_PRIORITY:
+                continue
+            targets.setdefault(str(source_id), {}).setdefault(refset_id, set()).add(str(target_id))
+            active[str(target_id)] = bool(target_active)
+
+        next_concept = {}
+        for source_id, by_refset in targets.items():
+            strongest = next(by_refset[refset_id] for refset_id in ASSOCIATION_PRIORITY if refset_id in by_refset)
+            if len(strongest) == 1:
+                next_concept[source_id] = next(iter(strongest))
+
+        self._substitutes = {}
+        for source_id in next_concept:
+            self._resolve(source_id, next_concept, active)
+        # Identifies the substitutions, so results that depend on them can tell when they change
+        self.fingerprint = hashlib.sha1(json.dumps(sorted(self._substitutes.items())).encode()).hexdigest()[:12]
+
+    def _resolve(self, concept_id, next_concept, active):
+        # walks the chain once, then stores the outcome for every concept on it
+        chain = []
+        seen = set()
+        substitute = None
+        while concept_id in next_concept and concept_id not in seen:
+            if concept_id in self._substitutes:
+                substitute = self._substitutes[concept_id]
+                break
+            chain.append(concept_id)
+            seen.add(concept_id)
+            concept_id = next_concept[concept_id]
+            if active.get(concept_id):
+                substitute = concept_id
+                break
+        for chained_id in chain:
+            self._substitutes[chained_id] = substitute
+
+    @classmethod
+    def from_rf2_index(cls, db_path):
+        """
+        Builds the map from the associations of an index built by models.rf2_index.build_index.
+        """
+        return cls(RF2Index(db_path).associations())
+
+    def __len__(self):
+        return sum(1 for substitute in self._substitutes.values() if substitute is not None)
+
+    def resolve(self, concept_id):
+        """
+        Returns the active substitute of an inactive concept, or None if it has none.
+        """
+        return self._substitutes.get(str(concept_id))
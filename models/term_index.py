@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+
+from models.normalizer import compile_ignorable
+
+EXACT = "EXACT"
+SYNONYM = "SYNONYM"
+NORMALIZED_DESCRIPTION = "NORMALIZED DESCRIPTION"
+
+
+class TermIndex:
+    """
+    Index from term to the concepts it identifies, used to decide the EXACT, SYNONYM and NORMALIZED
+    DESCRIPTION match tiers with hash lookups instead of comparing the input against every description.
+
+    Two maps are kept: the raw PT and FSN of each concept (EXACT), and every PT, FSN and acceptable or
+    preferred description after synonym normalization (SYNONYM, and NORMALIZED DESCRIPTION once the
+    ignorable strings are removed from the input). Descriptions are normalized once, when the concept
+    is added, rather than for every input.
+    """
+
+    def __init__(self, normalize, ignorable_strings=(), fingerprint=None):
+        """
+        Args:
+            normalize (callable): The synonym normalization applied to terms and inputs.
+            ignorable_strings (iterable): Strings removed from the normalized input for the
+                NORMALIZED DESCRIPTION tier.
+            fingerprint (str): Identifies the release and normalization the terms come from; saved with
+                the index so that load_or_create can tell a stale file (default: None).
+        """
+        self.normalize = normalize
+        self.fingerprint = fingerprint
+        self.ignorable_strings = list(ignorable_strings)
+        self._ignorable_pattern = compile_ignorable(self.ignorable_strings)
+        self._exact_terms = {}
+        self._normalized_terms = {}
+        self._concept_terms = {}
+        # Normalized terms in the order they were first indexed, so consumers can pick up only new ones
+        self._term_order = []
+        self._lock = threading.Lock()
+
+    def __contains__(self, concept_id):
+        return str(concept_id) in self._concept_terms
+
+    def __len__(self):
+        return len(self._concept_terms)
+
+    def add_concept(self, concept_id, preferred_term, fully_specified_name, description_terms):
+        """
+        Adds a concept's terms to the index.
+
+        Args:
+            concept_id (str): The SNOMED concept ID.
+            preferred_term (str): The concept's preferred term.
+            fully_specified_name (str): The concept's fully specified name.
+            description_terms (list): The concept's acceptable and preferred description terms.
+        """
+        concept_id = str(concept_id)
+        terms = [term for term in [preferred_term, fully_specified_name] + list(description_terms) if term]
+        normalized_terms = {self.normalize(term) for term in terms}
+        with self._lock:
+            for term in (preferred_term, fully_specified_name):
+                if term:
+                    self._exact_terms.setdefault(term, set()).add(concept_id)
+            for term in normalized_terms:
+                if term not in self._normalized_terms:
+                    self._normalized_terms[term] = set()
+                    self._term_order.append(term)
+                self._normalized_terms[term].add(concept_id)
+            self._concept_terms[concept_id] = sorted(normalized_terms)
+
+    def normalized_terms(self):
+        """
+        Returns (normalized term, concept IDs) pairs for every indexed term.
+        """
+        with self._lock:
+            return [(term, set(concept_ids)) for term, concept_ids in self._normalized_terms.items()]
+
+    def new_terms(self, start):
+        """
+        Returns the normalized terms first indexed after the first `start` ones; pass the number of terms
+        seen so far to get only those added since.
+        """
+        with self._lock:
+            return self._term_order[start:]
+
+    def term_concepts(self, term):
+        """
+        Returns the IDs of the concepts that have the normalized term (empty if it is not indexed).
+        """
+        with self._lock:
+            return set(self._normalized_terms.get(term, ()))
+
+    def concept_terms(self, concept_id):
+        """
+        Returns the normalized terms of an indexed concept (empty if it is not indexed).
+        """
+        return self._concept_terms.get(str(concept_id), [])
+
+    def strip_ignorable(self, text):
+        if self._ignorable_pattern is None:
+            return text
+        return self._ignorable_pattern.sub('', text)
+
+    def lookup(self, input_display):
+        """
+        Finds every indexed concept the input display text matches, with the strongest tier it matches at.
+
+        Args:
+            input_display (str): The display text supplied by the source system.
+
+        Returns:
+            dict: Concept ID to matched reason (EXACT, SYNONYM or NORMALIZED DESCRIPTION).
+        """
+        matches = {concept_id: EXACT for concept_id in self._exact_terms.get(input_display, ())}
+        normalized_input_display = self.normalize(input_display)
+        for concept_id in self._normalized_terms.get(normalized_input_display, ()):
+            matches.setdefault(concept_id, SYNONYM)
+        modified_display = self.strip_ignorable(normalized_input_display)
+        if modified_display != normalized_input_display:
+            for concept_id in self._normalized_terms.get(modified_display, ()):
+                matches.setdefault(concept_id, NORMALIZED_DESCRIPTION)
+        return matches
+
+    def match(self, concept_id, input_display):
+        """
+        Returns the tier at which the input display text matches the given concept, or None.
+        """
+        return self.lookup(input_display).get(str(concept_id))
+
+    def save(self, path):
+        """
+        Writes the index to a JSON file so later runs can load it instead of rebuilding it.
+        """
+        with self._lock:
+            data = {
+                "fingerprint": self.fingerprint,
+                "ignorable_strings": self.ignorable_strings,
+                "concept_terms": dict(self._concept_terms),
+                "exact_terms": {term: sorted(ids) for term, ids in self._exact_terms.items()},
+            }
+        with open(path, "w") as output_file:
+            json.dump(data, output_file)
+
+    @classmethod
+    def load(cls, path, normalize):
+        """
+        Loads an index written by save. `normalize` must be the normalization the index was built with.
+        """
+        with open(path) as input_file:
+            data = json.load(input_file)
+        index = cls(normalize, data["ignorable_strings"], data.get("fingerprint"))
+        index._concept_terms = data["concept_terms"]
+        index._exact_terms = {term: set(ids) for term, ids in data["exact_terms"].items()}
+        index._normalized_terms = {}
+        for concept_id, terms in index._concept_terms.items():
+            for term in terms:
+                if term not in index._normalized_terms:
+                    index._normalized_terms[term] = set()
+                    index._term_order.append(term)
+                index._normalized_terms[term].add(concept_id)
+        return index
+
+    @classmethod
+    def load_or_create(cls, path, normalize, ignorable_strings=(), fingerprint=None):
+        """
+        Loads the index saved to `path` if it was built for the given fingerprint, else returns an empty
+        index to rebuild. An index is never reused when the fingerprint is unknown (None).
+        """
+        if path and os.path.exists(path):
+            index = cls.load(path, normalize)
+            if fingerprint is not None and index.fingerprint == fingerprint:
+                return index
+            print(f"Term index in {path} was built for {index.fingerprint}, not {fingerprint}: rebuilding it")
+        return cls(normalize, ignorable_strings, fingerprint)